@@ -1 +1,2 @@
+from aggregates import Sum, Avg, Min, Max, Count
 from filterator import Filterable
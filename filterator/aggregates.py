@@ -0,0 +1,157 @@
+from utils import get_accessor
+
+
+__all__ = (
+    'Sum',
+    'Avg',
+    'Min',
+    'Max',
+    'Count',
+    'Aggregation',
+)
+
+
+class Aggregate(object):
+    """
+    Aggregate of values of `name` (a `__`-separated path).
+    Aggregates are folded over items one at a time: start() creates
+    the initial state, step() adds a value to it and finish() turns it
+    into the result. None values are skipped.
+    """
+
+    __slots__ = ('name', 'accessor')
+
+    def __init__(self, name):
+        self.name = name
+        self.accessor = get_accessor(name)
+
+    def start(self):
+        raise NotImplementedError
+
+    def step(self, state, value):
+        raise NotImplementedError
+
+    def finish(self, state):
+        return state
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and self.name == other.name
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__class__, self.name))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
+
+class Sum(Aggregate):
+    __slots__ = ()
+
+    def start(self):
+        return 0
+
+    def step(self, state, value):
+        return state + value
+
+
+class Avg(Aggregate):
+    __slots__ = ()
+
+    def start(self):
+        return [0, 0]
+
+    def step(self, state, value):
+        state[0] += value
+        state[1] += 1
+        return state
+
+    def finish(self, state):
+        total, count = state
+        if not count:
+            return None
+        return total / float(count)
+
+
+class Min(Aggregate):
+    __slots__ = ()
+
+    def start(self):
+        return None
+
+    def step(self, state, value):
+        if state is None or value < state:
+            return value
+        return state
+
+
+class Max(Aggregate):
+    __slots__ = ()
+
+    def start(self):
+        return None
+
+    def step(self, state, value):
+        if state is None or value > state:
+            return value
+        return state
+
+
+class Count(Aggregate):
+    """
+    Counts items, or items having a value of `name` if it's given
+    """
+
+    __slots__ = ()
+
+    def __init__(self, name=None):
+        self.name = name
+        self.accessor = identity if name is None else get_accessor(name)
+
+    def start(self):
+        return 0
+
+    def step(self, state, value):
+        return state + 1
+
+
+def identity(item):
+    return item
+
+
+class Aggregation(object):
+    """
+    A set of named aggregates computed together in a single pass
+    """
+
+    def __init__(self, aggregates):
+        self.aliases = aggregates.keys()
+        self.aggregates = aggregates.values()
+        self.accessors = [aggregate.accessor for aggregate in self.aggregates]
+        self.steps = [aggregate.step for aggregate in self.aggregates]
+
+    def start(self):
+        return [aggregate.start() for aggregate in self.aggregates]
+
+    def add(self, states, item):
+        for position, accessor in enumerate(self.accessors):
+            value = accessor(item)
+            if value is not None:
+                states[position] = self.steps[position](states[position], value)
+
+    def finish(self, states):
+        return dict(
+            (alias, aggregate.finish(state))
+            for alias, aggregate, state in zip(self.aliases, self.aggregates, states)
+        )
+
+    def compute(self, items):
+        states = self.start()
+        for item in items:
+            self.add(states, item)
+        return self.finish(states)
+
+    def describe(self):
+        return ', '.join('%s=%r' % (alias, aggregate) for alias, aggregate in zip(self.aliases, self.aggregates))
@@ -0,0 +1,83 @@
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore
+
+from filterator import Filterable
+
+
+__all__ = (
+    'AsyncFilterable',
+    'Concurrency',
+)
+
+
+class Concurrency(object):
+    """
+    Settings for evaluating filtering chains and invoke() calls which wait
+    on I/O. Items are processed in a pool of threads, with a bounded semaphore
+    keeping at most `limit` calls in flight, and results are yielded
+    in their original order as soon as their turn comes.
+    """
+
+    PENDING_ITEMS_PER_SLOT = 4
+
+    def __init__(self, limit=16):
+        self.limit = limit
+
+    def filter(self, filtered, iterable):
+        for item, passed in self.map_items(filtered.get_test(), iterable):
+            if passed:
+                yield item
+
+    def map(self, function, iterable):
+        for _, result in self.map_items(function, iterable):
+            yield result
+
+    def map_batches(self, function, batches):
+        return self.map(function, batches)
+
+    def map_items(self, function, iterable):
+        """
+        Yields (item, function(item)) pairs in order of items
+        """
+        slots = BoundedSemaphore(self.limit)
+
+        def call(item):
+            try:
+                return function(item)
+            finally:
+                slots.release()
+
+        pool = ThreadPool(self.limit)
+        try:
+            pending = deque()
+            max_pending = self.limit * self.PENDING_ITEMS_PER_SLOT
+            for item in iterable:
+                slots.acquire()
+                pending.append((item, pool.apply_async(call, (item,))))
+                while pending and (pending[0][1].ready() or len(pending) > max_pending):
+                    item, result = pending.popleft()
+                    yield item, result.get()
+            while pending:
+                item, result = pending.popleft()
+                yield item, result.get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def describe(self):
+        return 'Evaluate up to %d items concurrently in threads' % self.limit
+
+
+class AsyncFilterable(Filterable):
+    """
+    Filterable for sources and predicates that block on I/O.
+    Filtering chains are evaluated with Concurrency(concurrency),
+    so waiting predicates overlap instead of running one after another.
+    Terminal commands (exists(), first(), get()) stop dispatching
+    tests as soon as their result is known.
+    """
+
+    def __init__(self, iterable, concurrency=16):
+        super(AsyncFilterable, self).__init__(iterable)
+        self.parallelism = Concurrency(concurrency)
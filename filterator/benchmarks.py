@@ -0,0 +1,267 @@
+"""
+Throughput benchmarks for commands and constraints.
+
+Every benchmark runs in a separate process against a synthetic dataset
+generated from a fixed seed, and reports one JSON object per line:
+operations and rows per second along with peak memory growth.
+Pass a previous run as --compare to report regressions.
+
+    python benchmarks.py --sizes 1000 100000 --output run.jsonl
+    python benchmarks.py --sizes 1000 100000 --compare run.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import resource
+import sys
+import time
+from collections import namedtuple
+
+from constraints import ConstraintsFactory
+from errors import MultipleValuesReturned
+from filterator import Filterable
+
+
+RECORD_KINDS = ('namedtuple', 'object', 'dict')
+DEFAULT_SIZES = (1000, 10000, 100000)
+SEED = 1
+
+
+Vehicle = namedtuple('Vehicle', 'type manufacturer')
+
+
+class Record(namedtuple('Record', 'name age sex score tags vehicle')):
+    def is_adult(self):
+        return self.age >= 18
+
+    def get_score(self, multiplier=1):
+        return self.score * multiplier
+
+
+class PlainRecord(object):
+    def __init__(self, name, age, sex, score, tags, vehicle):
+        self.name = name
+        self.age = age
+        self.sex = sex
+        self.score = score
+        self.tags = tags
+        self.vehicle = vehicle
+
+    def is_adult(self):
+        return self.age >= 18
+
+    def get_score(self, multiplier=1):
+        return self.score * multiplier
+
+
+def generate_records(kind, size, seed=SEED):
+    rng = random.Random(seed)
+    vehicles = [
+        None,
+        Vehicle('car', 'ford'),
+        Vehicle('car', 'fiat'),
+        Vehicle('bicycle', 'nsbikes'),
+    ]
+    records = []
+    for _ in xrange(size):
+        fields = dict(
+            name='Name%d' % rng.randint(0, size),
+            age=rng.randint(0, 99),
+            sex=rng.choice('MF'),
+            score=rng.random(),
+            tags=['tag'] * rng.randint(0, 3),
+            vehicle=rng.choice(vehicles),
+        )
+        if kind == 'namedtuple':
+            records.append(Record(**fields))
+        elif kind == 'object':
+            records.append(PlainRecord(**fields))
+        else:
+            if fields['vehicle'] is not None:
+                fields['vehicle'] = fields['vehicle']._asdict()
+            records.append(fields)
+    return records
+
+
+LOOKUP_ARGUMENTS = {
+    'exact': ('name', 'Name42'),
+    'iexact': ('name', 'name42'),
+    'startswith': ('name', 'Name4'),
+    'istartswith': ('name', 'name4'),
+    'endswith': ('name', '7'),
+    'iendswith': ('name', 'E7'),
+    'contains': ('name', '42'),
+    'icontains': ('name', 'E42'),
+    'icontains_any': ('name', ['E42', '17', 'ME99']),
+    'in_prefixes': ('name', ['Name4', 'Name17', 'Name99']),
+    'regex': ('name', re.compile(r'^Name\d*7$')),
+    'gt': ('age', 50),
+    'gte': ('age', 50),
+    'lt': ('age', 50),
+    'lte': ('age', 50),
+    'in': ('age', range(0, 100, 7)),
+    'range': ('age', (20, 40)),
+    'isnull': ('vehicle', False),
+    'count': ('tags', 2),
+}
+
+
+def build_benchmarks():
+    """
+    Returns (name, record kinds, function) triples,
+    the function taking a Filterable and running a query to completion
+    """
+    benchmarks = []
+    for keyword in sorted(ConstraintsFactory.KEYWORD_TO_CONSTRAINT_CLASS_MAP):
+        if keyword in LOOKUP_ARGUMENTS:
+            name, value = LOOKUP_ARGUMENTS[keyword]
+            constraint = {'%s__%s' % (name, keyword): value}
+            benchmarks.append(('filter_%s' % keyword, RECORD_KINDS, make_filter(constraint)))
+    benchmarks.extend([
+        ('filter_deep_path', RECORD_KINDS, make_filter({'vehicle__type': 'car'})),
+        ('filter_shared_prefix', RECORD_KINDS, make_filter({'vehicle__type': 'car', 'vehicle__manufacturer__startswith': 'f'})),
+        ('filter_multiple', RECORD_KINDS, make_filter({'sex': 'M', 'age__gte': 18, 'name__contains': '1'})),
+        ('filter_callable', RECORD_KINDS, lambda records: list(records.filter(lambda record: True))),
+        ('exclude_multiple', RECORD_KINDS, lambda records: list(records.exclude(sex='M', age__lt=18))),
+        ('filter_chain', RECORD_KINDS, lambda records: list(records.filter(sex='F').exclude(age__lt=18).filter(score__gt=0.5))),
+        ('order_by_key', RECORD_KINDS, lambda records: list(records.order_by('age', 'name'))),
+        ('order_by_reversed_key', RECORD_KINDS, lambda records: list(records.order_by('-age', '-name'))),
+        ('order_by_mixed_directions', RECORD_KINDS, lambda records: list(records.order_by('-age', 'name'))),
+        ('order_by_top_10', RECORD_KINDS, lambda records: records.order_by('-score')[:10]),
+        ('get', RECORD_KINDS, get_missing),
+        ('first', RECORD_KINDS, lambda records: records.first(age=200)),
+        ('count', RECORD_KINDS, lambda records: records.filter(sex='M').count()),
+        ('sum', RECORD_KINDS, lambda records: records.sum('score')),
+        ('exists', RECORD_KINDS, lambda records: records.exists(age=200)),
+        ('invoke', ('namedtuple', 'object'), lambda records: records.invoke('is_adult')),
+        ('invoke_with_arguments', ('namedtuple', 'object'), lambda records: records.invoke('get_score', multiplier=2)),
+    ])
+    return benchmarks
+
+
+def make_filter(constraints):
+    return lambda records: list(records.filter(**constraints))
+
+
+def get_missing(records):
+    try:
+        records.get(age=200)
+    except MultipleValuesReturned:
+        pass
+
+
+def get_peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(function, kind, size, repeat):
+    records = Filterable(generate_records(kind, size))
+    baseline = get_peak_memory_kb()
+    timings = []
+    for _ in xrange(repeat):
+        started = time.time()
+        function(records)
+        timings.append(time.time() - started)
+    best = max(min(timings), 1e-9)
+    return {
+        'seconds': best,
+        'ops_per_sec': 1 / best,
+        'rows_per_sec': size / best,
+        'peak_memory_kb': get_peak_memory_kb() - baseline,
+    }
+
+
+def run_isolated(name, kind, size, repeat):
+    """
+    Runs a benchmark in a child process, so peak memory isn't shared with other runs
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        result = pool.apply(run_by_name, (name, kind, size, repeat))
+    finally:
+        pool.terminate()
+        pool.join()
+    result.update(benchmark=name, records=kind, size=size)
+    return result
+
+
+def run_by_name(name, kind, size, repeat):
+    for benchmark_name, _, function in build_benchmarks():
+        if benchmark_name == name:
+            return measure(function, kind, size, repeat)
+    raise KeyError(name)
+
+
+def run(sizes, kinds=RECORD_KINDS, names=None, repeat=3):
+    for name, supported_kinds, _ in build_benchmarks():
+        if names and name not in names:
+            continue
+        for kind in kinds:
+            if kind not in supported_kinds:
+                continue
+            for size in sizes:
+                yield run_isolated(name, kind, size, repeat)
+
+
+def get_result_key(result):
+    return result['benchmark'], result['records'], result['size']
+
+
+def find_regressions(baseline, results, threshold):
+    """
+    Returns pairs of baseline and current results whose throughput
+    dropped by more than `threshold` (a fraction)
+    """
+    previous = dict((get_result_key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        old = previous.get(get_result_key(result))
+        if old is not None and result['ops_per_sec'] < old['ops_per_sec'] * (1 - threshold):
+            regressions.append((old, result))
+    return regressions
+
+
+def load_results(path):
+    with open(path) as results:
+        return [json.loads(line) for line in results if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark filterator commands and constraints')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--records', nargs='+', choices=RECORD_KINDS, default=RECORD_KINDS)
+    parser.add_argument('--benchmarks', nargs='+', help='run only these benchmarks')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='also write results to this file')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='throughput drop considered a regression')
+    arguments = parser.parse_args(argv)
+
+    output = open(arguments.output, 'w') if arguments.output else None
+    results = []
+    try:
+        for result in run(arguments.sizes, arguments.records, arguments.benchmarks, arguments.repeat):
+            line = json.dumps(result, sort_keys=True)
+            print line
+            sys.stdout.flush()
+            if output:
+                output.write(line + '\n')
+            results.append(result)
+    finally:
+        if output:
+            output.close()
+
+    if arguments.compare:
+        regressions = find_regressions(load_results(arguments.compare), results, arguments.threshold)
+        for old, new in regressions:
+            sys.stderr.write('Regression: %s/%s/%d %.1f -> %.1f ops/sec\n' % (
+                new['benchmark'], new['records'], new['size'], old['ops_per_sec'], new['ops_per_sec']
+            ))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
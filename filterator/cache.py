@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+
+from query import Page
+
+
+__all__ = (
+    'ResultCache',
+    'CachedItems',
+    'copy_result',
+    'get_command_key',
+)
+
+
+class ResultCache(object):
+    """
+    LRU cache of query results with optional time-to-live (in seconds)
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns a (found, value) pair
+        """
+        try:
+            expires_at, value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return False, None
+        if expires_at is not None and expires_at < time.time():
+            self.misses += 1
+            return False, None
+        self.entries[key] = expires_at, value
+        self.hits += 1
+        return True, value
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        expires_at = None if self.ttl is None else time.time() + self.ttl
+        self.entries[key] = expires_at, value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def get_info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+        }
+
+
+class CachedItems(object):
+    """
+    Materialized items of a cached Filterable result
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+
+def copy_result(result):
+    """
+    Returns a copy of a cached result's containers (items themselves
+    aren't copied), so callers changing it don't change later hits
+    """
+    if isinstance(result, CachedItems):
+        return CachedItems(list(result.items))
+    if isinstance(result, Page):
+        return result._replace(items=list(result.items))
+    if isinstance(result, dict):
+        return result.copy()
+    if isinstance(result, list):
+        return list(result)
+    return result
+
+
+def get_command_key(command_cls, args, kwargs):
+    """
+    Returns a hashable representation of a command call.
+    Raises TypeError if some of its arguments can't be hashed.
+    """
+    key = (
+        command_cls.__name__,
+        tuple(map(make_hashable, args)),
+        tuple(sorted((name, make_hashable(value)) for name, value in kwargs.iteritems())),
+    )
+    hash(key)
+    return key
+
+
+def make_hashable(value):
+    if isinstance(value, (list, tuple)):
+        return value.__class__.__name__, tuple(map(make_hashable, value))
+    if isinstance(value, (set, frozenset)):
+        return 'set', frozenset(map(make_hashable, value))
+    if isinstance(value, dict):
+        return 'dict', tuple(sorted((key, make_hashable(item)) for key, item in value.iteritems()))
+    return value
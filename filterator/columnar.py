@@ -0,0 +1,278 @@
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from constraints import (
+    ConstraintsFactory,
+    CallableConstraint,
+    ExactConstraint,
+    GtConstraint,
+    GteConstraint,
+    LtConstraint,
+    LteConstraint,
+    IsnullConstraint,
+    InConstraint,
+    RangeConstraint,
+    ContainsConstraint,
+    StartsWithConstraint,
+    EndsWithConstraint,
+)
+from commands import CURSOR_WITHOUT_ORDERING
+from compiler import compile_projection
+from filterator import Filterable
+from query import LazyIterable, Page
+from utils import get_accessor
+
+
+__all__ = (
+    'ColumnarFilterable',
+)
+
+
+class ColumnarTable(object):
+    """
+    Items along with values of their fields, stored as NumPy arrays
+    """
+
+    def __init__(self, items, fields):
+        self.items = items
+        self.columns = dict((field, self.build_column(field, items)) for field in fields)
+
+    def build_column(self, name, items):
+        return build_array(map(get_accessor(name), items))
+
+    def get_column(self, name, positions):
+        if name in self.columns:
+            return self.columns[name][positions]
+        return self.build_column(name, [self.items[position] for position in positions])
+
+
+class ColumnarSelection(LazyIterable):
+    """
+    Rows of a table at `positions`, which follow `order_keys` when given
+    """
+
+    def __init__(self, table, positions, order_keys=()):
+        self.table = table
+        self.positions = positions
+        self.order_keys = order_keys
+
+    def __iter__(self):
+        items = self.table.items
+        return (items[position] for position in self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get_item(self, index):
+        return self.table.items[self.positions[index]]
+
+    def get_slice(self, key):
+        items = self.table.items
+        return [items[position] for position in self.positions[key]]
+
+    def explain(self):
+        return ['Select %d of %d rows of columns %s' % (
+            len(self.positions), len(self.table.items), ', '.join(sorted(self.table.columns))
+        )]
+
+
+class ColumnarFilterable(Filterable):
+    """
+    Filterable for flat records which keeps their fields in NumPy arrays.
+    Lookups on stored fields are evaluated as boolean masks over whole columns,
+    anything else (callables, other paths and lookups) falls back
+    to evaluation item by item.
+    """
+
+    def __init__(self, iterable, fields=None):
+        if numpy is None:
+            raise ImportError('ColumnarFilterable requires numpy')
+        if not isinstance(iterable, ColumnarSelection):
+            items = list(iterable)
+            if fields is None:
+                fields = guess_fields(items)
+            table = ColumnarTable(items, fields)
+            iterable = ColumnarSelection(table, numpy.arange(len(items)))
+        super(ColumnarFilterable, self).__init__(iterable)
+
+    @property
+    def table(self):
+        return self.iterable.table
+
+    @property
+    def positions(self):
+        return self.iterable.positions
+
+    def filter(self, *callables, **constraints):
+        masks = self.get_masks(callables, constraints)
+        return self.select(reduce(numpy.logical_and, masks, numpy.ones(len(self.positions), dtype=bool)))
+
+    def exclude(self, *callables, **constraints):
+        masks = self.get_masks(callables, constraints)
+        return self.select(~reduce(numpy.logical_or, masks, numpy.zeros(len(self.positions), dtype=bool)))
+
+    def order_by(self, *keys):
+        if not keys:
+            return self
+        columns = [self.get_sort_column(key) for key in reversed(keys)]
+        return self.select_positions(self.positions[numpy.lexsort(columns)], keys)
+
+    def after(self, cursor):
+        """
+        Selects ordered rows whose keys come after `cursor`: those equal
+        to it in the first few keys and coming after it in the next one
+        """
+        keys = self.get_order_keys()
+        mask = numpy.zeros(len(self.positions), dtype=bool)
+        equal = numpy.ones(len(self.positions), dtype=bool)
+        for key, value in zip(keys, cursor):
+            column = self.table.get_column(key.lstrip('-'), self.positions)
+            following = column < value if key.startswith('-') else column > value
+            mask |= equal & following
+            equal &= column == value
+        return self.select(mask)
+
+    def paginate(self, page_size, cursor=None):
+        if page_size < 1:
+            raise ValueError('Page size must be positive')
+        ordered = self if cursor is None else self.after(cursor)
+        items = ordered.iterable[:page_size + 1]
+        if len(items) <= page_size:
+            return Page(items, None, False)
+        items = items[:page_size]
+        get_cursor = compile_projection([key.lstrip('-') for key in self.get_order_keys()])
+        return Page(items, get_cursor(items[-1]), True)
+
+    def get_order_keys(self):
+        if not self.iterable.order_keys:
+            raise ValueError(CURSOR_WITHOUT_ORDERING)
+        return self.iterable.order_keys
+
+    def count(self):
+        return len(self.positions)
+
+    def sum(self, attr):
+        column = self.table.get_column(attr, self.positions)
+        if column.dtype.kind in 'biuf':
+            return column.sum().item()
+        return sum(column)
+
+    def group_by(self, *names):
+        # Groups aren't flat records, so they are aggregated item by item
+        return Filterable(self.iterable).group_by(*names)
+
+    def select(self, mask):
+        return self.select_positions(self.positions[mask], self.iterable.order_keys)
+
+    def select_positions(self, positions, order_keys=()):
+        return self.__class__(ColumnarSelection(self.table, positions, order_keys))
+
+    def get_mutable_items(self):
+        # Columns are built once, so append(), remove(), update()
+        # and view() would leave them describing other items
+        raise TypeError('ColumnarFilterable is immutable, build a new one from the changed items')
+
+    def create_index(self, name, kind='hash'):
+        raise TypeError('ColumnarFilterable has no indexes, its columns are scanned as a whole')
+
+    def get_masks(self, callables, constraints):
+        constraints = map(CallableConstraint, callables) + [
+            ConstraintsFactory(name, value).get_constraint()
+            for name, value in constraints.items()
+        ]
+        return map(self.get_constraint_mask, constraints)
+
+    def get_constraint_mask(self, constraint):
+        mask_function = MASK_FUNCTIONS.get(type(constraint))
+        if mask_function is not None and constraint.name in self.table.columns:
+            mask = mask_function(self.table.get_column(constraint.name, self.positions), constraint.value)
+            if mask is not None:
+                return mask
+        return numpy.fromiter(
+            (bool(constraint.fits(item)) for item in self.iterable),
+            dtype=bool,
+            count=len(self.positions)
+        )
+
+    def get_sort_column(self, key):
+        column = self.table.get_column(key.lstrip('-'), self.positions)
+        if column.dtype.kind not in 'iuf':
+            _, column = numpy.unique(column, return_inverse=True)
+        if key.startswith('-'):
+            return -column
+        return column
+
+
+def build_array(values):
+    array = numpy.array(values)
+    if array.ndim == 1:
+        return array
+    array = numpy.empty(len(values), dtype=object)
+    for position, value in enumerate(values):
+        array[position] = value
+    return array
+
+
+def guess_fields(items):
+    if not items:
+        return ()
+    item = items[0]
+    if isinstance(item, dict):
+        return item.keys()
+    if isinstance(item, tuple) and hasattr(item, '_fields'):
+        return item._fields
+    return getattr(item, '__dict__', {}).keys()
+
+
+def is_scalar(value):
+    return value is None or numpy.isscalar(value)
+
+
+def comparison_mask(function):
+    def get_mask(column, value):
+        if is_scalar(value):
+            return function(column, value)
+    return get_mask
+
+
+def string_mask(function):
+    def get_mask(column, value):
+        if column.dtype.kind in 'SU' and isinstance(value, basestring):
+            return function(column, value)
+    return get_mask
+
+
+def isnull_mask(column, value):
+    if column.dtype.kind in 'SU':
+        return (column != '') == value
+    return column.astype(bool) == value
+
+
+def in_mask(column, values):
+    if all(is_scalar(value) for value in values):
+        return numpy.in1d(column, list(values))
+
+
+def range_mask(column, bounds):
+    low, high = bounds
+    if is_scalar(low) and is_scalar(high):
+        return (column >= low) & (column <= high)
+
+
+MASK_FUNCTIONS = {
+    ExactConstraint: comparison_mask(operator.eq),
+    GtConstraint: comparison_mask(operator.gt),
+    GteConstraint: comparison_mask(operator.ge),
+    LtConstraint: comparison_mask(operator.lt),
+    LteConstraint: comparison_mask(operator.le),
+    IsnullConstraint: isnull_mask,
+    InConstraint: in_mask,
+    RangeConstraint: range_mask,
+    ContainsConstraint: string_mask(lambda column, value: numpy.char.find(column, value) >= 0),
+    StartsWithConstraint: string_mask(lambda column, value: numpy.char.startswith(column, value)),
+    EndsWithConstraint: string_mask(lambda column, value: numpy.char.endswith(column, value)),
+}
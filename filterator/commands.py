@@ -1,24 +1,63 @@
-from itertools import imap
-from operator import attrgetter, methodcaller
+import heapq
+from functools import total_ordering
+from itertools import chain, ifilter, imap, islice
 
+from aggregates import Aggregation
+from compiler import compile_projection
 from errors import MultipleValuesReturned
 from constraints import ConstraintsFactory, CallableConstraint
-from utils import resolve_value
+from indexes import SortedIndex
+from instrumentation import InstrumentedConstraint, instrument_test
+from parallel import BatchCall, MethodCall, iter_chunks
+from planner import ConstraintsPlan
+from query import (
+    FilteredIterable,
+    GroupedIterable,
+    JoinedIterable,
+    LazyIterable,
+    LimitedIterable,
+    OrderedIterable,
+    Page,
+    ProjectedIterable,
+)
+from utils import get_accessor
 
 
 __all__ = (
     'FilterCommand',
     'ExcludeCommand',
     'OrderCommand',
+    'LimitCommand',
+    'AfterCommand',
+    'PaginateCommand',
     'GetCommand',
     'CountCommand',
     'SumCommand',
     'ExistsCommand',
+    'FirstCommand',
+    'LastCommand',
     'InvokeCommand',
+    'InvokeBatchedCommand',
+    'AggregateCommand',
+    'GroupByCommand',
+    'JoinCommand',
+    'ValuesCommand',
+    'ValuesListCommand',
 )
 
 
 class BaseCommand(object):
+    CACHEABLE = True
+    # Results of cacheable non-terminal commands are cached as lists,
+    # except lazy nodes later commands build on (orderings resumed by
+    # cursors), which are passed on to cache results of those commands
+    MATERIALIZED_IN_CACHE = True
+    # Terminal commands do their work when executed,
+    # the rest build lazy query plans
+    IS_TERMINAL = True
+
+    __slots__ = ('context', 'args', 'kwargs', 'iterable')
+
     def __init__(self, context, iterable, *args, **kwargs):
         self.context = context
         self.args = args
@@ -29,13 +68,18 @@ class BaseCommand(object):
         raise NotImplementedError()
 
     def wrap(self, iterable):
-        return self.context.__class__(iterable)
+        return self.context.derive(iterable)
 
 
 class BaseFilteringCommand(BaseCommand):
+    IS_TERMINAL = False
+
+    __slots__ = ('constraints', 'plan')
+
     def __init__(self, context, iterable, *args, **kwargs):
         super(BaseFilteringCommand, self).__init__(context, iterable, *args, **kwargs)
         self.constraints = self.generate_constraints_from_args_and_kwargs()
+        self.plan = ConstraintsPlan(self.constraints, self.REJECTS_WHEN_FITS)
 
     def generate_constraints_from_args_and_kwargs(self):
         return map(self.convert_callable_to_constraint, self.args) + \
@@ -49,34 +93,78 @@ class BaseFilteringCommand(BaseCommand):
         return ConstraintsFactory(name, value).get_constraint()
 
     def execute(self):
-        return self.wrap(
-            filter(self.passes_test, self.iterable)
-        )
+        return self.wrap(self.build_query())
+
+    def build_query(self):
+        if isinstance(self.iterable, FilteredIterable):
+            return self.iterable.chain(self)
+        return FilteredIterable(self.iterable, [self], self.context.indexes, self.context.parallelism)
 
     def passes_test(self, item):
-        raise NotImplementedError
+        return self.get_test()(item)
+
+    def get_test(self):
+        return self.plan.get_test()
+
+    def get_instrumented_test(self, stats):
+        plan = ConstraintsPlan(
+            [
+                InstrumentedConstraint(constraint, constraint_stats)
+                for constraint, constraint_stats in zip(self.plan.get_ordered_constraints(), stats.constraints)
+            ],
+            self.REJECTS_WHEN_FITS
+        )
+        return instrument_test(plan.get_test(), stats)
+
+    def get_indexable_constraints(self):
+        return []
 
 
 class FilterCommand(BaseFilteringCommand):
-    def passes_test(self, item):
-        for constraint in self.constraints:
-            if not constraint.fits(item):
-                return False
-        return True
+    REJECTS_WHEN_FITS = False
+
+    __slots__ = ()
+
+    def get_indexable_constraints(self):
+        return self.constraints
 
 
 class ExcludeCommand(BaseFilteringCommand):
-    def passes_test(self, item):
-        for constraint in self.constraints:
-            if constraint.fits(item):
-                return False
-        return True
+    REJECTS_WHEN_FITS = True
+
+    __slots__ = ()
 
 
 class OrderCommand(BaseCommand):
+    MATERIALIZED_IN_CACHE = False
+    IS_TERMINAL = False
+
+    __slots__ = ()
+
     def execute(self):
-        ordering_strategy = self.get_ordering_strategy()
-        return ordering_strategy.get_ordered_iterable()
+        strategy = self.get_ordering_strategy()
+        return self.wrap(
+            OrderedIterable(self.iterable, strategy, self.context.streaming, index=self.find_sorted_index(strategy))
+        )
+
+    def find_sorted_index(self, strategy):
+        """
+        Returns a sorted index on the only key, which items of the list
+        it was built on (or a filtering chain over it) can be walked in
+        """
+        if len(self.args) != 1 or not isinstance(strategy, KeyOrderingStrategy):
+            return None
+        if isinstance(self.iterable, FilteredIterable) and self.iterable.parallelism is None:
+            indexes = self.iterable.indexes
+        elif isinstance(self.iterable, list):
+            indexes = self.context.indexes
+        else:
+            return None
+        name = strategy.strip_minus(self.args[0])
+        for index in indexes:
+            if isinstance(index, SortedIndex) and index.name == name:
+                return index
+        return None
 
     def get_ordering_strategy(self):
         return self.build_strategy(self.choose_ordering_strategy_class())
@@ -85,7 +173,7 @@ class OrderCommand(BaseCommand):
         if self.is_key_sorting_possible():
             return KeyOrderingStrategy
         else:
-            return CmpFunctionOrderingStrategy
+            return MixedKeyOrderingStrategy
 
     def is_key_sorting_possible(self):
         if self.is_all_keys_reversed_or_all_keys_unreversed():
@@ -122,10 +210,54 @@ class BaseOrderingStrategy(object):
     def __init__(self, iterable, keys):
         self.iterable = iterable
         self.keys = keys
+        self.accessors = dict(
+            (key, get_accessor(self.strip_minus(key))) for key in keys
+        )
 
     def get_ordered_iterable(self):
         raise NotImplementedError
 
+    def get_comparison_key(self):
+        """
+        Returns a key function ordering items ascendingly the same way
+        get_ordered_iterable() does
+        """
+        raise NotImplementedError
+
+    def get_top(self, count):
+        """
+        Returns the first `count` items of get_ordered_iterable(),
+        keeping original order of equal items
+        """
+        return heapq.nsmallest(count, self.iterable, key=self.get_comparison_key())
+
+    def get_attributes_function(self):
+        if len(self.keys) == 1:
+            accessor = self.accessors[self.keys[0]]
+            return lambda item: (accessor(item),)
+        return compile_projection([self.strip_minus(key) for key in self.keys])
+
+    def get_attributes(self, item):
+        return self.get_attributes_function()(item)
+
+    def after(self, cursor):
+        """
+        Returns a strategy ordering only items which come after items
+        whose attributes are `cursor`
+        """
+        get_comparison_key = self.get_comparison_key()
+        cursor_key = self.get_cursor_key(tuple(cursor))
+        return self.__class__(
+            ifilter(lambda item: get_comparison_key(item) > cursor_key, self.iterable), self.keys
+        )
+
+    def get_cursor_key(self, cursor):
+        """
+        Returns the value get_comparison_key() would give items
+        whose attributes are `cursor`
+        """
+        raise NotImplementedError
+
     def is_starts_with_minus(self, key):
         return key.startswith('-')
 
@@ -135,16 +267,26 @@ class BaseOrderingStrategy(object):
 
 class KeyOrderingStrategy(BaseOrderingStrategy):
     def get_ordered_iterable(self):
-        return sorted(self.iterable, key=self.get_attributes, reverse=self.is_reversed())
+        return sorted(self.iterable, key=self.get_attributes_function(), reverse=self.is_reversed())
 
     def is_reversed(self):
         return self.is_all_keys_start_with_minus()
 
-    def get_attributes(self, item):
-        return tuple(resolve_value(item, key) for key in self.get_keys())
+    def get_top(self, count):
+        if self.is_reversed():
+            return heapq.nlargest(count, self.iterable, key=self.get_attributes_function())
+        return heapq.nsmallest(count, self.iterable, key=self.get_attributes_function())
+
+    def get_comparison_key(self):
+        get_attributes = self.get_attributes_function()
+        if not self.is_reversed():
+            return get_attributes
+        return lambda item: ReversedKey(get_attributes(item))
 
-    def get_keys(self):
-        return map(self.strip_minus, self.keys)
+    def get_cursor_key(self, cursor):
+        if self.is_reversed():
+            return ReversedKey(cursor)
+        return cursor
 
     def is_all_keys_start_with_minus(self):
         for key in self.keys:
@@ -153,57 +295,297 @@ class KeyOrderingStrategy(BaseOrderingStrategy):
         return True
 
 
-class CmpFunctionOrderingStrategy(BaseOrderingStrategy):
+class MixedKeyOrderingStrategy(BaseOrderingStrategy):
+    """
+    Orders by keys of different directions.
+    Keys are resolved once per item, then the decorated items are sorted
+    stably by every key, starting from the least significant one
+    """
+
     def get_ordered_iterable(self):
-        return sorted(self.iterable, cmp=self.cmp_function)
+        get_attributes = self.get_attributes_function()
+        decorated = [(get_attributes(item), item) for item in self.iterable]
+        for position in reversed(xrange(len(self.keys))):
+            decorated.sort(
+                key=lambda pair: pair[0][position],
+                reverse=self.is_starts_with_minus(self.keys[position])
+            )
+        return [item for _, item in decorated]
 
-    def cmp_function(self, item, other):
-        for key in self.keys:
-            reverse = True if self.is_starts_with_minus(key) else False
-            if reverse:
-                key = self.strip_minus(key)
-            result = cmp(resolve_value(item, key), resolve_value(other, key))
-            if result == 0:
-                continue
-            return result * (-1 if reverse else 1)
-        return 0
-
-
-class GetCommand(BaseCommand):
-    def execute(self):
-        if not (self.args or self.kwargs):
-            if len(self.iterable) != 1:
-                raise MultipleValuesReturned('More than one value returned')
-            return self.iterable[0]
-        else:
-            return self.context.filter(*self.args, **self.kwargs).get()
+    def get_comparison_key(self):
+        get_attributes = self.get_attributes_function()
+        reversed_keys = map(self.is_starts_with_minus, self.keys)
+        return lambda item: tuple([
+            ReversedKey(value) if reverse else value
+            for value, reverse in zip(get_attributes(item), reversed_keys)
+        ])
+
+    def get_cursor_key(self, cursor):
+        return tuple([
+            ReversedKey(value) if self.is_starts_with_minus(key) else value
+            for value, key in zip(cursor, self.keys)
+        ])
+
+
+@total_ordering
+class ReversedKey(object):
+    """
+    Wraps a sort key to invert its order
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class LimitCommand(BaseCommand):
+    IS_TERMINAL = False
+
+    __slots__ = ()
+
+    def execute(self):
+        count, = self.args
+        if isinstance(self.iterable, LazyIterable):
+            return self.wrap(self.iterable.limit(count))
+        return self.wrap(LimitedIterable(self.iterable, count))
+
+
+CURSOR_WITHOUT_ORDERING = 'Cursors need an ordering, call order_by() first'
+
+
+class AfterCommand(BaseCommand):
+    MATERIALIZED_IN_CACHE = False
+    IS_TERMINAL = False
+
+    __slots__ = ()
+
+    def execute(self):
+        cursor, = self.args
+        return self.wrap(get_ordered(self.iterable).after(cursor))
+
+
+class PaginateCommand(BaseCommand):
+    __slots__ = ()
+
+    def execute(self):
+        page_size, cursor = self.args
+        if page_size < 1:
+            raise ValueError('Page size must be positive')
+        ordered = get_ordered(self.iterable)
+        if cursor is not None:
+            ordered = ordered.after(cursor)
+        items = list(ordered.limit(page_size + 1))
+        if len(items) <= page_size:
+            return Page(items, None, False)
+        items = items[:page_size]
+        return Page(items, ordered.get_cursor(items[-1]), True)
+
+
+def get_ordered(iterable):
+    """
+    Returns an ordering, or a filtering chain over one, which can be
+    resumed after a cursor
+    """
+    if isinstance(iterable, FilteredIterable) and isinstance(iterable.source, OrderedIterable):
+        return iterable
+    if not isinstance(iterable, OrderedIterable):
+        raise ValueError(CURSOR_WITHOUT_ORDERING)
+    return iterable
+
+
+class BaseTerminalCommand(BaseCommand):
+    """
+    Commands that may be given constraints of their own,
+    which are applied lazily before the command is executed
+    """
+
+    __slots__ = ()
+
+    def execute(self):
+        if self.args or self.kwargs:
+            return self.execute_on_filtered()
+        return self.execute_on_iterable()
+
+    def execute_on_filtered(self):
+        filtered = self.context.filter(*self.args, **self.kwargs)
+        return self.__class__(filtered, filtered.iterable).execute()
+
+    def execute_on_iterable(self):
+        raise NotImplementedError
+
+
+class GetCommand(BaseTerminalCommand):
+    __slots__ = ()
+
+    def execute_on_iterable(self):
+        items = list(islice(self.iterable, 2))
+        if len(items) != 1:
+            raise MultipleValuesReturned('More than one value returned')
+        return items[0]
+
+
+class FirstCommand(BaseTerminalCommand):
+    __slots__ = ()
+
+    def execute_on_iterable(self):
+        for item in self.iterable:
+            return item
+        return None
+
+
+class LastCommand(BaseTerminalCommand):
+    __slots__ = ()
+
+    def execute_on_iterable(self):
+        if isinstance(self.iterable, (list, tuple)):
+            return self.iterable[-1] if self.iterable else None
+        item = None
+        for item in self.iterable:
+            pass
+        return item
 
 
 class InvokeCommand(BaseCommand):
+    CACHEABLE = False
+
+    __slots__ = ('method_name',)
+
     def __init__(self, context, iterable, method_name, *args, **kwargs):
         self.method_name = method_name
         super(InvokeCommand, self).__init__(context, iterable, *args, **kwargs)
 
     def execute(self):
-        return map(
-            methodcaller(self.method_name, *self.args, **self.kwargs),
-            self.iterable
+        call = MethodCall(self.method_name, self.args, self.kwargs)
+        return self.collect(self.map(call, self.iterable))
+
+    def map(self, function, iterable):
+        parallelism = self.context.parallelism
+        if parallelism is not None:
+            return parallelism.map(function, iterable)
+        return imap(function, iterable)
+
+    def collect(self, results):
+        if self.context.streaming is not None:
+            return results
+        return list(results)
+
+
+class InvokeBatchedCommand(BaseCommand):
+    """
+    Calls a function once per batch of items rather than a method per item
+    """
+
+    CACHEABLE = False
+
+    __slots__ = ()
+
+    def execute(self):
+        function, batch_size = self.args
+        results = chain.from_iterable(
+            self.map_batches(BatchCall(function), iter_chunks(self.iterable, batch_size))
         )
+        if self.context.streaming is not None:
+            return results
+        return list(results)
+
+    def map_batches(self, function, batches):
+        parallelism = self.context.parallelism
+        if parallelism is not None:
+            return parallelism.map_batches(function, batches)
+        return imap(function, batches)
 
 
 class CountCommand(BaseCommand):
+    __slots__ = ()
+
     def execute(self):
-        return len(self.iterable)
+        try:
+            return len(self.iterable)
+        except TypeError:
+            return sum(1 for _ in self.iterable)
 
 
 class SumCommand(BaseCommand):
+    __slots__ = ()
+
     def execute(self):
-        return sum(imap(attrgetter(self.get_attr_to_sum()), self.iterable))
+        return sum(imap(get_accessor(self.get_attr_to_sum()), self.iterable))
 
     def get_attr_to_sum(self):
         return self.args[0]
 
 
-class ExistsCommand(BaseCommand):
+class ExistsCommand(BaseTerminalCommand):
+    __slots__ = ()
+
+    def execute_on_iterable(self):
+        for _ in self.iterable:
+            return True
+        return False
+
+
+class AggregateCommand(BaseCommand):
+    __slots__ = ()
+
+    def execute(self):
+        aggregation = Aggregation(self.kwargs)
+        if isinstance(self.iterable, GroupedIterable):
+            return self.wrap(self.iterable.aggregate(aggregation))
+        return aggregation.compute(self.iterable)
+
+
+class GroupByCommand(BaseCommand):
+    IS_TERMINAL = False
+    # Results are only meaningful to a following aggregate(),
+    # materializing them would keep every group's items in memory
+    CACHEABLE = False
+
+    __slots__ = ()
+
+    def execute(self):
+        return self.wrap(GroupedIterable(self.iterable, self.args))
+
+
+class ValuesCommand(BaseCommand):
+    IS_TERMINAL = False
+
+    __slots__ = ()
+
+    def execute(self):
+        return self.wrap(ProjectedIterable(self.iterable, self.args))
+
+
+class ValuesListCommand(BaseCommand):
+    IS_TERMINAL = False
+
+    __slots__ = ()
+
+    def execute(self):
+        flat = self.kwargs.get('flat', False)
+        if flat and len(self.args) != 1:
+            raise TypeError('flat is only supported for a single name')
+        return self.wrap(ProjectedIterable(self.iterable, self.args, as_dicts=False, flat=flat))
+
+
+class JoinCommand(BaseCommand):
+    IS_TERMINAL = False
+    # The other side may change without invalidating this Filterable's cache
+    CACHEABLE = False
+
+    __slots__ = ()
+
     def execute(self):
-        return bool(self.iterable)
+        other, keys, how = self.args
+        if how not in JoinedIterable.HOWS:
+            raise ValueError('Unknown join type: %r' % how)
+        return self.wrap(JoinedIterable(self.iterable, other, keys, how))
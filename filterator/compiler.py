@@ -0,0 +1,159 @@
+from utils import PATH_SEPARATOR, get_accessor, get_step
+
+
+__all__ = (
+    'compile_predicate',
+    'compile_projection',
+)
+
+
+# Constraints without a template are evaluated through their fits() method
+FITS_TEMPLATE = '%(operand)s(item)'
+
+_factories = {}
+
+
+def compile_predicate(constraints, rejects_when_fits=False):
+    """
+    Fuses constraints into a single function evaluating them in the given order.
+    Functions are generated once per query shape (constraint templates,
+    the way constraints are combined and path prefixes they share),
+    so queries of a known shape only bind their accessors and operands
+    to a cached factory.
+    """
+    templates, arguments, names = [], [], []
+    for constraint in constraints:
+        template = getattr(constraint, 'TEMPLATE', None)
+        if template is None:
+            template, operand = FITS_TEMPLATE, constraint.fits
+        else:
+            operand = constraint.get_operand()
+        templates.append(template)
+        arguments.append(getattr(constraint, 'accessor', None))
+        arguments.append(operand)
+        names.append(getattr(constraint, 'name', None) if '%(value)s' in template else None)
+    paths = SharedPaths(names)
+    shape = build_predicate_factory, tuple(templates), rejects_when_fits, paths.parents, paths.path_nodes
+    return get_factory(shape)(*(paths.get_steps() + arguments))
+
+
+def compile_projection(names):
+    """
+    Returns a function resolving values of `names` on an item as a tuple
+    """
+    paths = SharedPaths(names)
+    if not paths.shared:
+        accessors = map(get_accessor, names)
+        return lambda item: tuple([accessor(item) for accessor in accessors])
+    shape = build_projection_factory, paths.parents, paths.path_nodes
+    return get_factory(shape)(*paths.get_steps())
+
+
+def get_factory(shape):
+    try:
+        return _factories[shape]
+    except KeyError:
+        build_factory, arguments = shape[0], shape[1:]
+        factory = _factories[shape] = build_factory(*arguments)
+        return factory
+
+
+class SharedPaths(object):
+    """
+    Prefixes of paths which share any of them, numbered so that each
+    prefix is resolved once per item, by a single step from its parent.
+    Paths given as None, or all of them if nothing is shared,
+    are left to their own accessors.
+    """
+
+    def __init__(self, names):
+        self.shared = has_shared_prefixes(names)
+        self.nodes = {}
+        parents, self.segments = [], []
+        self.path_nodes = tuple(
+            self.add(name, parents) if self.shared and name is not None else None for name in names
+        )
+        self.parents = tuple(parents)
+
+    def add(self, name, parents):
+        parts = tuple(name.split(PATH_SEPARATOR))
+        for length in xrange(1, len(parts) + 1):
+            prefix = parts[:length]
+            if prefix not in self.nodes:
+                self.nodes[prefix] = len(parents)
+                parents.append(self.nodes.get(prefix[:-1], -1))
+                self.segments.append(prefix[-1])
+        return self.nodes[parts]
+
+    def get_steps(self):
+        return map(get_step, self.segments)
+
+
+def has_shared_prefixes(names):
+    prefixes = set()
+    for name in names:
+        if name is None:
+            continue
+        parts = tuple(name.split(PATH_SEPARATOR))
+        if parts[:1] in prefixes:
+            return True
+        prefixes.update(parts[:length] for length in xrange(1, len(parts) + 1))
+    return False
+
+
+def build_predicate_factory(templates, rejects_when_fits, parents, path_nodes):
+    parameters = ['step%d' % node for node in xrange(len(parents))]
+    lines, resolved = [], set()
+    condition = 'if %s:' if rejects_when_fits else 'if not (%s):'
+    for number, (template, node) in enumerate(zip(templates, path_nodes)):
+        accessor, operand, value = 'accessor%d' % number, 'operand%d' % number, 'value%d' % number
+        parameters.extend([accessor, operand])
+        if node is not None:
+            lines.extend(get_resolving_lines(node, parents, resolved))
+            value = 'node%d' % node
+        elif '%(value)s' in template:
+            lines.append('%s = %s(item)' % (value, accessor))
+        lines.append(condition % (template % {'value': value, 'operand': operand}))
+        lines.append('    return False')
+    lines.append('return True')
+    return build_factory(parameters, 'predicate', lines)
+
+
+def build_projection_factory(parents, path_nodes):
+    parameters = ['step%d' % node for node in xrange(len(parents))]
+    lines, resolved = [], set()
+    for node in path_nodes:
+        lines.extend(get_resolving_lines(node, parents, resolved))
+    lines.append('return (%s,)' % ', '.join('node%d' % node for node in path_nodes))
+    return build_factory(parameters, 'project', lines)
+
+
+def get_resolving_lines(node, parents, resolved):
+    """
+    Returns lines binding the value of a prefix to node<N> and whether
+    resolution of longer paths stops there to final<N>, resolving
+    its parents first unless they already are
+    """
+    if node in resolved:
+        return []
+    resolved.add(node)
+    parent = parents[node]
+    if parent == -1:
+        return ['node%d, final%d = step%d(item)' % (node, node, node)]
+    return get_resolving_lines(parent, parents, resolved) + [
+        'if final%d:' % parent,
+        '    node%d, final%d = node%d, True' % (node, node, parent),
+        'else:',
+        '    node%d, final%d = step%d(node%d)' % (node, node, node, parent),
+    ]
+
+
+def build_factory(parameters, name, lines):
+    source = '\n'.join(
+        ['def factory(%s):' % ', '.join(parameters), '    def %s(item):' % name] +
+        ['        ' + line for line in lines] +
+        ['    return %s' % name]
+    )
+    namespace = {}
+    exec(compile(source, '<filterator %s>' % name, 'exec'), namespace)
+    return namespace['factory']
@@ -1,68 +1,237 @@
 import operator
 import re
 
-from utils import resolve_value
+from utils import FOLD_METHOD, PATH_SEPARATOR, fold, get_accessor
 
 
 class BaseConstraint(object):
+    """
+    Lookups which only make sense for present values (string lookups,
+    contains, regex and count) don't fit None, which is also
+    what a path resolves to when an object along it is None.
+    """
+
+    # Static estimates used to order constraints within a query:
+    # relative cost of a single check and share of items expected to fit
+    COST = 1
+    SELECTIVITY = 0.5
+    # Expression evaluating the constraint within a compiled predicate,
+    # with the resolved value and the result of get_operand() substituted
+    TEMPLATE = None
+    # Whether the planner may evaluate the constraint in a different order
+    REORDERABLE = True
+
+    __slots__ = ('name', 'value', 'accessor')
+
     def __init__(self, name, value):
         self.name = name
         self.value = value
+        self.accessor = get_accessor(name)
 
     def resolve_value(self, item):
-        return resolve_value(item, self.name)
+        return self.accessor(item)
 
     def fits(self, item):
+        return self.fits_value(self.accessor(item))
+
+    def fits_value(self, value):
         raise NotImplementedError
 
+    def get_operand(self):
+        return self.value
+
+    def get_cost(self):
+        return self.COST + self.name.count(PATH_SEPARATOR)
+
+    def __reduce__(self):
+        return self.__class__, (self.name, self.value)
+
+    def describe(self):
+        keyword = ConstraintsFactory.get_keyword(self.__class__)
+        return '%s%s%s=%r' % (self.name, ConstraintsFactory.KEYWORD_SEPARATOR, keyword, self.value)
+
 
 class ExactConstraint(BaseConstraint):
-    def fits(self, item):
-        return self.resolve_value(item) == self.value
+    TEMPLATE = '%(value)s == %(operand)s'
+    SELECTIVITY = 0.1
 
+    __slots__ = ()
 
-class CaseInsensitiveExactConstraint(BaseConstraint):
-    def fits(self, item):
-        return self.resolve_value(item).lower() == self.value.lower()
+    def fits_value(self, value):
+        return value == self.value
+
+
+class BaseCaseInsensitiveConstraint(BaseConstraint):
+    """
+    Compares case-folded values. The searched value is folded once,
+    and fits_folded() can be given values folded in advance.
+    """
+
+    COST = 2
+
+    __slots__ = ('folded',)
+
+    def __init__(self, name, value):
+        super(BaseCaseInsensitiveConstraint, self).__init__(name, value)
+        self.folded = self.fold_operand(value)
+
+    def fold_operand(self, value):
+        return fold(value)
+
+    def fits_value(self, value):
+        return value is not None and self.fits_folded(fold(value))
+
+    def fits_folded(self, value):
+        raise NotImplementedError
+
+    def get_operand(self):
+        return self.folded
+
+
+class CaseInsensitiveExactConstraint(BaseCaseInsensitiveConstraint):
+    TEMPLATE = '%(value)s is not None and %(value)s.' + FOLD_METHOD + '() == %(operand)s'
+    SELECTIVITY = 0.1
+
+    __slots__ = ()
+
+    def fits_folded(self, value):
+        return value == self.folded
 
 
 class StartsWithConstraint(BaseConstraint):
-    def fits(self, item):
-        return self.resolve_value(item).startswith(self.value)
+    TEMPLATE = '%(value)s is not None and %(value)s.startswith(%(operand)s)'
+    SELECTIVITY = 0.2
 
+    __slots__ = ()
 
-class CaseInsensitiveStartsWithConstraint(BaseConstraint):
-    def fits(self, item):
-        return self.resolve_value(item).lower().startswith(self.value.lower())
+    def fits_value(self, value):
+        return value is not None and value.startswith(self.value)
+
+
+class CaseInsensitiveStartsWithConstraint(BaseCaseInsensitiveConstraint):
+    TEMPLATE = '%(value)s is not None and %(value)s.' + FOLD_METHOD + '().startswith(%(operand)s)'
+    SELECTIVITY = 0.2
+
+    __slots__ = ()
+
+    def fits_folded(self, value):
+        return value.startswith(self.folded)
 
 
 class EndsWithConstraint(BaseConstraint):
-    def fits(self, item):
-        return self.resolve_value(item).endswith(self.value)
+    TEMPLATE = '%(value)s is not None and %(value)s.endswith(%(operand)s)'
+    SELECTIVITY = 0.2
 
+    __slots__ = ()
 
-class CaseInsensitiveEndsWithConstraint(BaseConstraint):
-    def fits(self, item):
-        return self.resolve_value(item).lower().endswith(self.value.lower())
+    def fits_value(self, value):
+        return value is not None and value.endswith(self.value)
+
+
+class CaseInsensitiveEndsWithConstraint(BaseCaseInsensitiveConstraint):
+    TEMPLATE = '%(value)s is not None and %(value)s.' + FOLD_METHOD + '().endswith(%(operand)s)'
+    SELECTIVITY = 0.2
+
+    __slots__ = ()
+
+    def fits_folded(self, value):
+        return value.endswith(self.folded)
+
+
+class InPrefixesConstraint(BaseConstraint):
+    """
+    Fits values starting with any of the given prefixes,
+    checked by a single startswith() call with a tuple of them
+    """
+
+    TEMPLATE = '%(value)s is not None and %(value)s.startswith(%(operand)s)'
+    SELECTIVITY = 0.3
+
+    __slots__ = ('prefixes',)
+
+    def __init__(self, name, value):
+        super(InPrefixesConstraint, self).__init__(name, value)
+        self.prefixes = tuple(value)
+
+    def fits_value(self, value):
+        return value is not None and value.startswith(self.prefixes)
+
+    def get_operand(self):
+        return self.prefixes
 
 
 class RegexConstraint(BaseConstraint):
+    TEMPLATE = '%(value)s is not None and %(operand)s(%(value)s)'
+    COST = 5
+    SELECTIVITY = 0.3
+
+    __slots__ = ('regex',)
+
     def __init__(self, name, value):
         super(RegexConstraint, self).__init__(name, value)
         self.regex = re.compile(self.value)
 
-    def fits(self, item):
-        return self.regex.match(self.resolve_value(item))
+    def fits_value(self, value):
+        return value is not None and self.regex.match(value)
+
+    def get_operand(self):
+        return self.regex.match
 
 
 class ContainsConstraint(BaseConstraint):
-    def fits(self, item):
-        return self.value in self.resolve_value(item)
+    TEMPLATE = '%(value)s is not None and %(operand)s in %(value)s'
+    COST = 2
+    SELECTIVITY = 0.3
+
+    __slots__ = ()
+
+    def fits_value(self, value):
+        return value is not None and self.value in value
+
+
+class CaseInsensitiveContainsConstraint(BaseCaseInsensitiveConstraint):
+    TEMPLATE = '%(value)s is not None and %(operand)s in %(value)s.' + FOLD_METHOD + '()'
+    COST = 3
+    SELECTIVITY = 0.3
+
+    __slots__ = ()
+
+    def fits_folded(self, value):
+        return self.folded in value
+
+
+class CaseInsensitiveContainsAnyConstraint(BaseCaseInsensitiveConstraint):
+    """
+    Fits values containing any of the given substrings, found by a single
+    scan with a regular expression combining all of them
+    """
+
+    TEMPLATE = '%(value)s is not None and %(operand)s(%(value)s.' + FOLD_METHOD + '())'
+    COST = 4
+    SELECTIVITY = 0.3
+
+    __slots__ = ()
+
+    def fold_operand(self, value):
+        substrings = sorted(set(map(fold, value)), key=len, reverse=True)
+        if not substrings:
+            # An empty pattern would match every string
+            return find_nothing
+        return re.compile('|'.join(map(re.escape, substrings)), re.UNICODE).search
+
+    def fits_folded(self, value):
+        return self.folded(value)
+
+
+def find_nothing(string):
+    return None
 
 
 class BaseComparativeConstraint(BaseConstraint):
-    def fits(self, item):
-        return self.COMPARATIVE_FUNCTION(self.resolve_value(item), self.value)
+    __slots__ = ()
+
+    def fits_value(self, value):
+        return self.COMPARATIVE_FUNCTION(value, self.value)
 
     @property
     def COMPARATIVE_FUNCTION(self):
@@ -70,29 +239,103 @@ class BaseComparativeConstraint(BaseConstraint):
 
 
 class GtConstraint(BaseComparativeConstraint):
+    TEMPLATE = '%(value)s > %(operand)s'
     COMPARATIVE_FUNCTION = operator.gt
 
+    __slots__ = ()
+
 
 class GteConstraint(BaseComparativeConstraint):
+    TEMPLATE = '%(value)s >= %(operand)s'
     COMPARATIVE_FUNCTION = operator.ge
 
+    __slots__ = ()
+
 
 class LtConstraint(BaseComparativeConstraint):
+    TEMPLATE = '%(value)s < %(operand)s'
     COMPARATIVE_FUNCTION = operator.lt
 
+    __slots__ = ()
+
 
 class LteConstraint(BaseComparativeConstraint):
+    TEMPLATE = '%(value)s <= %(operand)s'
     COMPARATIVE_FUNCTION = operator.le
 
+    __slots__ = ()
+
+
+class InConstraint(BaseConstraint):
+    """
+    Fits values equal to any of the given ones. Hashable values are
+    frozen into a set once, so membership is checked in O(1) per item,
+    unhashable ones (on either side) are compared one by one.
+    """
+
+    TEMPLATE = '%(operand)s(%(value)s)'
+    SELECTIVITY = 0.2
+
+    __slots__ = ('values',)
+
+    def __init__(self, name, value):
+        super(InConstraint, self).__init__(name, value)
+        try:
+            self.values = frozenset(value)
+        except TypeError:
+            self.values = tuple(value)
+
+    def fits_value(self, value):
+        try:
+            return value in self.values
+        except TypeError:
+            return any(value == candidate for candidate in self.values)
+
+    def get_operand(self):
+        return self.fits_value
+
+
+class RangeConstraint(BaseConstraint):
+    """
+    Fits values between the given (low, high) bounds, inclusive
+    """
+
+    TEMPLATE = '%(operand)s[0] <= %(value)s <= %(operand)s[1]'
+    SELECTIVITY = 0.3
+
+    __slots__ = ('bounds',)
+
+    def __init__(self, name, value):
+        super(RangeConstraint, self).__init__(name, value)
+        low, high = value
+        self.bounds = low, high
+
+    def fits_value(self, value):
+        low, high = self.bounds
+        return low <= value <= high
+
+    def get_operand(self):
+        return self.bounds
+
 
 class IsnullConstraint(BaseComparativeConstraint):
-    def fits(self, item):
-        return bool(self.resolve_value(item)) == self.value
+    TEMPLATE = 'bool(%(value)s) == %(operand)s'
+
+    __slots__ = ()
+
+    def fits_value(self, value):
+        return bool(value) == self.value
 
 
 class CountConstraint(BaseConstraint):
-    def fits(self, item):
-        return len(self.resolve_value(item)) == self.value
+    TEMPLATE = '%(value)s is not None and len(%(value)s) == %(operand)s'
+    COST = 2
+    SELECTIVITY = 0.3
+
+    __slots__ = ()
+
+    def fits_value(self, value):
+        return value is not None and len(value) == self.value
 
 
 class CallableConstraint(object):
@@ -104,12 +347,32 @@ class CallableConstraint(object):
     It's separate, different constraint class
     """
 
+    COST = 10
+    SELECTIVITY = 0.5
+    TEMPLATE = '%(operand)s(item)'
+    # Callables may rely on earlier ones, e.g. one checking for None
+    REORDERABLE = False
+
+    __slots__ = ('callable',)
+
     def __init__(self, callable):
         self.callable = callable
 
     def fits(self, item):
         return self.callable(item)
 
+    def get_operand(self):
+        return self.callable
+
+    def __reduce__(self):
+        return self.__class__, (self.callable,)
+
+    def get_cost(self):
+        return self.COST
+
+    def describe(self):
+        return '<callable %s>' % getattr(self.callable, '__name__', repr(self.callable))
+
 
 class ConstraintsFactory(object):
     KEYWORD_SEPARATOR = '__'
@@ -122,12 +385,17 @@ class ConstraintsFactory(object):
         'istartswith': CaseInsensitiveStartsWithConstraint,
         'endswith': EndsWithConstraint,
         'iendswith': CaseInsensitiveEndsWithConstraint,
+        'in_prefixes': InPrefixesConstraint,
         'contains': ContainsConstraint,
+        'icontains': CaseInsensitiveContainsConstraint,
+        'icontains_any': CaseInsensitiveContainsAnyConstraint,
         'regex': RegexConstraint,
         'gt': GtConstraint,
         'gte': GteConstraint,
         'lt': LtConstraint,
         'lte': LteConstraint,
+        'in': InConstraint,
+        'range': RangeConstraint,
         'isnull': IsnullConstraint,
         'count': CountConstraint,
         }
@@ -136,17 +404,42 @@ class ConstraintsFactory(object):
         self.name = name
         self.value = value
 
+    @classmethod
+    def get_keyword(cls, constraint_cls):
+        for keyword, keyword_cls in cls.KEYWORD_TO_CONSTRAINT_CLASS_MAP.iteritems():
+            if keyword_cls is constraint_cls:
+                return keyword
+        return None
+
     def get_constraint(self):
-        prefix, suffix = self.get_name_and_keyword(self.name)
-        if suffix and suffix in self.KEYWORD_TO_CONSTRAINT_CLASS_MAP:
-            name = prefix
-            cls = self.KEYWORD_TO_CONSTRAINT_CLASS_MAP[suffix]
-        else:
-            name = self.name
-            cls = self.DEFAULT_CONSTRAINT_CLASS
+        name, cls = self.parse_lookup(self.name)
         return cls(name, self.value)
 
-    def get_name_and_keyword(self, name):
-        if not self.KEYWORD_SEPARATOR in name:
+    @classmethod
+    def parse_lookup(cls, lookup):
+        """
+        Returns the path and the constraint class of a lookup like
+        `path__to__field__keyword`, parsing each distinct lookup once
+        """
+        key = cls, lookup
+        try:
+            return _parsed_lookups[key]
+        except KeyError:
+            parsed = _parsed_lookups[key] = cls.resolve_lookup(lookup)
+            return parsed
+
+    @classmethod
+    def resolve_lookup(cls, lookup):
+        name, keyword = cls.get_name_and_keyword(lookup)
+        if keyword and keyword in cls.KEYWORD_TO_CONSTRAINT_CLASS_MAP:
+            return name, cls.KEYWORD_TO_CONSTRAINT_CLASS_MAP[keyword]
+        return lookup, cls.DEFAULT_CONSTRAINT_CLASS
+
+    @classmethod
+    def get_name_and_keyword(cls, name):
+        if not cls.KEYWORD_SEPARATOR in name:
             return name, None
-        return name.split(self.KEYWORD_SEPARATOR)
+        return name.rsplit(cls.KEYWORD_SEPARATOR, 1)
+
+
+_parsed_lookups = {}
@@ -1,13 +1,48 @@
+from weakref import WeakSet
+
+from cache import ResultCache, CachedItems, copy_result, get_command_key
 from commands import *
+from indexes import INDEX_CLASSES
+from instrumentation import hooks, CommandStats, timed
+from parallel import Parallelism
+from query import explain_iterable
+from streaming import Streaming, SinglePassIterable
+from utils import is_iterator
+from views import MaterializedView
 
 
 class Filterable(object):
+    parallelism = None
+    streaming = None
+    result_cache = None
+    query_key = ()
+
     def __init__(self, iterable):
         self.iterable = iterable
+        self.indexes = []
+        # Views are dropped once nothing else refers to them
+        self.views = WeakSet()
 
     def __iter__(self):
         return iter(self.iterable)
 
+    def __getitem__(self, key):
+        return self.iterable[key]
+
+    def __eq__(self, other):
+        if isinstance(other, (Filterable, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    # Filterables compare by their items, which may change
+    __hash__ = None
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
     def __repr__(self):
         return '<Filterable: %s>' % repr(self.iterable)
 
@@ -20,23 +55,276 @@ class Filterable(object):
     def order_by(self, *keys):
         return self.__execute_command(OrderCommand, *keys)
 
+    def limit(self, count):
+        return self.__execute_command(LimitCommand, count)
+
+    def after(self, cursor):
+        """
+        Returns ordered items coming after those whose ordering key
+        values are `cursor`, a tuple with a value per order_by() key.
+        Items with the same values as the cursor are skipped,
+        so the last key should be unique, e.g. order_by('name', 'id').
+        Orderings filtered by filter() or exclude() can be resumed too.
+        """
+        return self.__execute_command(AfterCommand, cursor)
+
+    def paginate(self, page_size, cursor=None):
+        """
+        Returns a Page of at most `page_size` ordered items after `cursor`.
+        Its cursor resumes after the page's last item (or is None
+        on the last page), so deep pages cost no more than the first one,
+        and a sorted index on a single order_by() key is walked from
+        the cursor instead of ordering all items.
+        """
+        return self.__execute_command(PaginateCommand, page_size, cursor)
+
     def get(self, *callables, **constrains):
         return self.__execute_command(GetCommand, *callables, **constrains)
 
     def invoke(self, method_name, *args, **kwargs):
         return self.__execute_command(InvokeCommand, method_name, *args, **kwargs)
 
+    def invoke_batched(self, function, batch_size=1000):
+        """
+        Calls `function` with lists of up to `batch_size` items, expecting
+        a result per item. `function` may be the name of a classmethod
+        or staticmethod of the items' class.
+        """
+        return self.__execute_command(InvokeBatchedCommand, function, batch_size)
+
     def count(self):
         return self.__execute_command(CountCommand)
 
     def sum(self, attr):
         return self.__execute_command(SumCommand, attr)
 
-    def exists(self):
-        return self.__execute_command(ExistsCommand)
+    def aggregate(self, **aggregates):
+        """
+        Computes aggregates (Sum, Avg, Min, Max, Count) in a single pass,
+        returning a dict of their results by keyword. After group_by(),
+        returns a Filterable of such dicts, one per group, which also
+        contain the values grouped by.
+        """
+        return self.__execute_command(AggregateCommand, **aggregates)
+
+    def group_by(self, *names):
+        return self.__execute_command(GroupByCommand, *names)
+
+    def values(self, *names):
+        return self.__execute_command(ValuesCommand, *names)
+
+    def values_list(self, *names, **kwargs):
+        return self.__execute_command(ValuesListCommand, *names, **kwargs)
+
+    def join(self, other, on, how='inner'):
+        """
+        Hash-joins with `other` where values of `on` paths are equal.
+        `on` is a (name, other name) pair, or a single name used on both sides.
+        'inner' joins result in Joined(left, right) pairs, 'semi' and 'anti'
+        ones keep items which have or lack a match. For membership in a
+        single field of another Filterable, `name__in=other.values_list(
+        other_name, flat=True)` does the same as a semi join.
+        """
+        if isinstance(on, basestring):
+            on = on, on
+        if isinstance(other, Filterable):
+            other = other.get_reiterable_items()
+        elif is_iterator(other):
+            other = list(other)
+        return self.__execute_command(JoinCommand, other, tuple(on), how)
+
+    def exists(self, *callables, **constraints):
+        return self.__execute_command(ExistsCommand, *callables, **constraints)
+
+    def first(self, *callables, **constraints):
+        return self.__execute_command(FirstCommand, *callables, **constraints)
+
+    def last(self, *callables, **constraints):
+        return self.__execute_command(LastCommand, *callables, **constraints)
+
+    def create_index(self, name, kind='hash'):
+        """
+        Indexes values of `name` for use by subsequent filter() calls.
+        'hash' indexes serve exact, iexact, isnull and in lookups,
+        'sorted' ones serve exact, gt, gte, lt, lte, in, range, startswith,
+        istartswith and in_prefixes, 'folded' ones keep case-folded strings
+        for iexact, istartswith, iendswith, icontains and icontains_any.
+        Iterables other than lists (tuples included) are copied into a list
+        first, which later mutations change in place. Indexes are kept
+        up to date by append(), extend(), remove() and update(), but go
+        stale if the list is mutated directly.
+        """
+        self.indexes.append(INDEX_CLASSES[kind](name, self.get_mutable_items()))
+
+    def view(self, *callables, **constraints):
+        """
+        Returns a MaterializedView of items passing the constraints, ordered
+        by keys given as `order_by`. append(), extend(), remove() and update()
+        keep it up to date by testing only the items they change, so items
+        shouldn't be mutated in place. Like indexes, views go stale
+        if the list is mutated directly. Views are no longer maintained
+        once nothing refers to them.
+        """
+        keys = constraints.pop('order_by', ())
+        if isinstance(keys, basestring):
+            keys = (keys,)
+        items = self.get_mutable_items()
+        test = FilterCommand(self, items, *callables, **constraints).get_test()
+        comparison_key = None
+        if keys:
+            comparison_key = OrderCommand(self, items, *keys).get_ordering_strategy().get_comparison_key()
+        view = MaterializedView(test, comparison_key, items)
+        self.views.add(view)
+        return view
+
+    def explain(self):
+        """
+        Describes how the query would be evaluated, without running it
+        """
+        return '\n'.join(explain_iterable(self.iterable))
+
+    def enable_cache(self, maxsize=128, ttl=None):
+        """
+        Caches results of queries made through this Filterable, keyed by
+        the whole chain of commands leading to them. Results are materialized,
+        and the cache is cleared by append(), extend() and remove().
+        """
+        self.result_cache = ResultCache(maxsize, ttl)
+
+    def cache_info(self):
+        if self.result_cache is None:
+            return None
+        return self.result_cache.get_info()
+
+    def append(self, item):
+        items = self.get_mutable_items()
+        items.append(item)
+        for index in self.indexes:
+            index.add(len(items) - 1, item)
+        for view in self.views:
+            view.add(item)
+        self.invalidate_cache()
+
+    def extend(self, iterable):
+        for item in iterable:
+            self.append(item)
+
+    def remove(self, item):
+        items = self.get_mutable_items()
+        position = items.index(item)
+        del items[position]
+        for index in self.indexes:
+            index.build(items)
+        for view in self.views:
+            view.discard(position, item)
+        self.invalidate_cache()
+
+    def update(self, item, new_item):
+        """
+        Replaces `item` with `new_item`, keeping its position
+        """
+        items = self.get_mutable_items()
+        position = items.index(item)
+        items[position] = new_item
+        for index in self.indexes:
+            index.build(items)
+        for view in self.views:
+            view.replace(position, item, new_item)
+        self.invalidate_cache()
+
+    def get_mutable_items(self):
+        if not isinstance(self.iterable, list):
+            self.iterable = list(self.iterable)
+        return self.iterable
+
+    def invalidate_cache(self):
+        if self.result_cache is not None:
+            self.result_cache.invalidate()
+
+    def parallel(self, workers=None, chunk_size=1000, threads=False, ordered=True):
+        """
+        Returns a copy which evaluates filter() and exclude() chains
+        and invoke() calls over a pool of `workers` processes (or threads,
+        for code releasing the GIL), `chunk_size` items per task.
+        Unless `ordered`, invoke() results come in order of completion.
+        """
+        filterable = self.derive_sharing_items(self.iterable)
+        filterable.parallelism = Parallelism(workers, chunk_size, threads, ordered)
+        return filterable
+
+    def stream(self, sort_buffer_size=100000):
+        """
+        Returns a copy suitable for iterables which don't fit in memory:
+        invoke() returns a generator and order_by() keeps at most
+        `sort_buffer_size` items in memory, spilling the rest to temporary files
+        """
+        iterable = self.iterable
+        if is_iterator(iterable):
+            iterable = SinglePassIterable(iterable)
+        filterable = self.derive_sharing_items(iterable)
+        filterable.streaming = Streaming(sort_buffer_size)
+        return filterable
+
+    def derive(self, iterable):
+        """
+        Returns a Filterable over `iterable` with the same execution settings
+        """
+        filterable = self.__class__(iterable)
+        filterable.parallelism = self.parallelism
+        filterable.streaming = self.streaming
+        return filterable
+
+    def derive_sharing_items(self, iterable):
+        """
+        Returns a Filterable over the same items, whose mutations keep
+        indexes, views and cached results of this one up to date
+        """
+        filterable = self.derive(iterable)
+        filterable.indexes = self.indexes
+        filterable.views = self.views
+        filterable.result_cache = self.result_cache
+        filterable.query_key = self.query_key
+        return filterable
 
     def __execute_command(self, cls, *args, **kwargs):
-        return self.__build_command(cls, *args, **kwargs).execute()
+        if hooks and cls.IS_TERMINAL:
+            return timed(lambda: self.__execute_cacheable_command(cls, *args, **kwargs), CommandStats(cls.__name__))
+        return self.__execute_cacheable_command(cls, *args, **kwargs)
+
+    def __execute_cacheable_command(self, cls, *args, **kwargs):
+        if self.result_cache is None or not cls.CACHEABLE:
+            return self.__build_command(cls, *args, **kwargs).execute()
+        try:
+            key = self.query_key + (get_command_key(cls, args, kwargs),)
+        except TypeError:
+            return self.__build_command(cls, *args, **kwargs).execute()
+        if not cls.MATERIALIZED_IN_CACHE:
+            return self.__keep_caching(self.__build_command(cls, *args, **kwargs).execute(), key)
+        found, result = self.result_cache.get(key)
+        if not found:
+            result = self.__build_command(cls, *args, **kwargs).execute()
+            if isinstance(result, Filterable):
+                result = CachedItems(list(result))
+            self.result_cache.set(key, result)
+        result = copy_result(result)
+        if isinstance(result, CachedItems):
+            return self.__derive_cached(result.items, key)
+        return result
+
+    def __derive_cached(self, items, key):
+        return self.__keep_caching(self.derive(items), key)
+
+    def __keep_caching(self, filterable, key):
+        filterable.result_cache = self.result_cache
+        filterable.query_key = key
+        return filterable
 
     def __build_command(self, cls, *args, **kwargs):
-        return cls(self, self.iterable, *args, **kwargs)
+        return cls(self, self.get_reiterable_items(), *args, **kwargs)
+
+    def get_reiterable_items(self):
+        # Queries iterate their source each time they are evaluated,
+        # so unless streaming, iterators are read into a list once
+        if self.streaming is None and is_iterator(self.iterable):
+            self.iterable = list(self.iterable)
+        return self.iterable
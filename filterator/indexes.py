@@ -0,0 +1,284 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from heapq import merge
+
+from constraints import (
+    ExactConstraint,
+    CaseInsensitiveExactConstraint,
+    IsnullConstraint,
+    GtConstraint,
+    GteConstraint,
+    LtConstraint,
+    LteConstraint,
+    StartsWithConstraint,
+    CaseInsensitiveStartsWithConstraint,
+    CaseInsensitiveEndsWithConstraint,
+    CaseInsensitiveContainsConstraint,
+    CaseInsensitiveContainsAnyConstraint,
+    InPrefixesConstraint,
+    InConstraint,
+    RangeConstraint,
+)
+from utils import fold, get_accessor
+
+
+__all__ = (
+    'HashIndex',
+    'SortedIndex',
+    'FoldedIndex',
+    'INDEX_CLASSES',
+    'select_positions',
+    'find_index',
+)
+
+
+class BaseIndex(object):
+    """
+    Maps values of a single attribute path to positions of items in a sequence.
+    Lookups return ascending lists of positions, so results keep original order.
+    """
+
+    CONSTRAINT_CLASSES = ()
+
+    def __init__(self, name, items):
+        self.name = name
+        self.accessor = get_accessor(name)
+        self.build(items)
+
+    def build(self, items):
+        raise NotImplementedError
+
+    def add(self, position, item):
+        """
+        Registers an item appended to the end of the sequence
+        """
+        raise NotImplementedError
+
+    def supports(self, constraint):
+        return type(constraint) in self.CONSTRAINT_CLASSES and constraint.name == self.name
+
+    def lookup(self, constraint):
+        raise NotImplementedError
+
+
+class HashIndex(BaseIndex):
+    CONSTRAINT_CLASSES = (
+        ExactConstraint,
+        CaseInsensitiveExactConstraint,
+        IsnullConstraint,
+        InConstraint,
+    )
+
+    def build(self, items):
+        self.buckets = defaultdict(list)
+        for position, item in enumerate(items):
+            self.buckets[self.accessor(item)].append(position)
+        self.folded_buckets = None
+
+    def add(self, position, item):
+        self.buckets[self.accessor(item)].append(position)
+        self.folded_buckets = None
+
+    def lookup(self, constraint):
+        if isinstance(constraint, CaseInsensitiveExactConstraint):
+            return self.get_folded_buckets().get(constraint.folded, [])
+        if isinstance(constraint, IsnullConstraint):
+            return self.merge_buckets(
+                positions for value, positions in self.buckets.iteritems()
+                if constraint.fits_value(value)
+            )
+        if isinstance(constraint, InConstraint):
+            try:
+                return self.merge_buckets(
+                    self.buckets[value] for value in constraint.values if value in self.buckets
+                )
+            except TypeError:
+                return None
+        try:
+            return self.buckets.get(constraint.value, [])
+        except TypeError:
+            return None
+
+    def get_folded_buckets(self):
+        if self.folded_buckets is None:
+            folded = defaultdict(list)
+            for value, positions in self.buckets.iteritems():
+                if isinstance(value, basestring):
+                    folded[fold(value)].append(positions)
+            self.folded_buckets = dict(
+                (value, self.merge_buckets(buckets)) for value, buckets in folded.iteritems()
+            )
+        return self.folded_buckets
+
+    def merge_buckets(self, buckets):
+        return list(merge(*buckets))
+
+
+class SortedIndex(BaseIndex):
+    CONSTRAINT_CLASSES = (
+        ExactConstraint,
+        GtConstraint,
+        GteConstraint,
+        LtConstraint,
+        LteConstraint,
+        StartsWithConstraint,
+        CaseInsensitiveStartsWithConstraint,
+        InPrefixesConstraint,
+        InConstraint,
+        RangeConstraint,
+    )
+
+    def build(self, items):
+        pairs = sorted((self.accessor(item), position) for position, item in enumerate(items))
+        self.keys = [key for key, _ in pairs]
+        self.positions = [position for _, position in pairs]
+        self.folded = None
+
+    def add(self, position, item):
+        key = self.accessor(item)
+        insertion_point = bisect_right(self.keys, key)
+        self.keys.insert(insertion_point, key)
+        self.positions.insert(insertion_point, position)
+        self.folded = None
+
+    def lookup(self, constraint):
+        if isinstance(constraint, CaseInsensitiveStartsWithConstraint):
+            keys, positions = self.get_folded()
+            return self.prefix_range(keys, positions, constraint.folded)
+        if isinstance(constraint, StartsWithConstraint):
+            return self.prefix_range(self.keys, self.positions, constraint.value)
+        if isinstance(constraint, InConstraint):
+            return sorted(set().union(*[
+                self.positions[bisect_left(self.keys, value):bisect_right(self.keys, value)]
+                for value in constraint.values
+            ]))
+        if isinstance(constraint, InPrefixesConstraint):
+            return sorted(set().union(*[
+                self.prefix_range(self.keys, self.positions, prefix) for prefix in constraint.prefixes
+            ]))
+        start, stop = self.get_bounds(constraint)
+        return sorted(self.positions[start:stop])
+
+    def iter_positions(self, reverse=False, cursor=None):
+        """
+        Yields positions in order of values (descending if `reverse`),
+        positions of equal values in ascending order, like a stable sort.
+        A 1-tuple `cursor` makes it start after its value.
+        """
+        keys, positions = self.keys, self.positions
+        if not reverse:
+            start = 0 if cursor is None else bisect_right(keys, cursor[0])
+            for index in xrange(start, len(keys)):
+                yield positions[index]
+            return
+        stop = len(keys) if cursor is None else bisect_left(keys, cursor[0])
+        while stop > 0:
+            start = bisect_left(keys, keys[stop - 1], 0, stop)
+            for index in xrange(start, stop):
+                yield positions[index]
+            stop = start
+
+    def get_bounds(self, constraint):
+        keys, value = self.keys, constraint.value
+        if isinstance(constraint, ExactConstraint):
+            return bisect_left(keys, value), bisect_right(keys, value)
+        if isinstance(constraint, GtConstraint):
+            return bisect_right(keys, value), len(keys)
+        if isinstance(constraint, GteConstraint):
+            return bisect_left(keys, value), len(keys)
+        if isinstance(constraint, LtConstraint):
+            return 0, bisect_left(keys, value)
+        if isinstance(constraint, RangeConstraint):
+            low, high = constraint.bounds
+            return bisect_left(keys, low), bisect_right(keys, high)
+        return 0, bisect_right(keys, value)
+
+    def prefix_range(self, keys, positions, prefix):
+        start = stop = bisect_left(keys, prefix)
+        while stop < len(keys) and isinstance(keys[stop], basestring) and keys[stop].startswith(prefix):
+            stop += 1
+        return sorted(positions[start:stop])
+
+    def get_folded(self):
+        if self.folded is None:
+            pairs = sorted(
+                (fold(key), position) for key, position in zip(self.keys, self.positions)
+                if isinstance(key, basestring)
+            )
+            self.folded = [key for key, _ in pairs], [position for _, position in pairs]
+        return self.folded
+
+
+class FoldedIndex(BaseIndex):
+    """
+    Keeps case-folded values of a string field, so case-insensitive
+    lookups are checked against them instead of folding values per query
+    """
+
+    CONSTRAINT_CLASSES = (
+        CaseInsensitiveExactConstraint,
+        CaseInsensitiveStartsWithConstraint,
+        CaseInsensitiveEndsWithConstraint,
+        CaseInsensitiveContainsConstraint,
+        CaseInsensitiveContainsAnyConstraint,
+    )
+
+    def build(self, items):
+        self.values = [self.fold_value(self.accessor(item)) for item in items]
+
+    def add(self, position, item):
+        self.values.append(self.fold_value(self.accessor(item)))
+
+    def fold_value(self, value):
+        if isinstance(value, basestring):
+            return fold(value)
+        return None
+
+    def lookup(self, constraint):
+        fits_folded = constraint.fits_folded
+        return [
+            position for position, value in enumerate(self.values)
+            if value is not None and fits_folded(value)
+        ]
+
+
+INDEX_CLASSES = {
+    'hash': HashIndex,
+    'sorted': SortedIndex,
+    'folded': FoldedIndex,
+}
+
+
+def select_positions(indexes, constraints):
+    """
+    Returns ascending positions of candidate items for the constraints
+    (all of which must hold), or None when no index can be used
+    """
+    candidates = None
+    for constraint in constraints:
+        positions = lookup(indexes, constraint)
+        if positions is None:
+            continue
+        if candidates is None:
+            candidates = set(positions)
+        else:
+            candidates.intersection_update(positions)
+    if candidates is None:
+        return None
+    return sorted(candidates)
+
+
+def find_index(indexes, constraint):
+    for index in indexes:
+        if index.supports(constraint):
+            return index
+    return None
+
+
+def lookup(indexes, constraint):
+    for index in indexes:
+        if index.supports(constraint):
+            positions = index.lookup(constraint)
+            if positions is not None:
+                return positions
+    return None
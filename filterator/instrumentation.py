@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+from timeit import default_timer
+
+
+__all__ = (
+    'add_hook',
+    'remove_hook',
+    'profile',
+    'CommandStats',
+    'ConstraintStats',
+)
+
+
+# Callables receiving CommandStats of every executed command.
+# Commands only check whether this list is empty when they start,
+# so instrumentation costs nothing while there are no hooks.
+hooks = []
+
+
+def add_hook(hook):
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+@contextmanager
+def profile():
+    """
+    Collects CommandStats of commands executed within the block into a list
+    """
+    report = []
+    hook = report.append
+    add_hook(hook)
+    try:
+        yield report
+    finally:
+        remove_hook(hook)
+
+
+def notify(stats):
+    for hook in list(hooks):
+        hook(stats)
+
+
+class ConstraintStats(object):
+    def __init__(self, constraint):
+        self.description = constraint.describe()
+        self.evaluations = 0
+        self.passed = 0
+        self.time = 0.0
+
+    def __repr__(self):
+        return '<ConstraintStats %s: %d evaluations, %d passed, %.6fs>' % (
+            self.description, self.evaluations, self.passed, self.time
+        )
+
+
+class CommandStats(object):
+    """
+    Rows scanned and passed by a command, the time it took,
+    and stats of its constraints
+    """
+
+    def __init__(self, name, constraints=()):
+        self.name = name
+        self.scanned = 0
+        self.passed = 0
+        self.time = 0.0
+        self.constraints = [ConstraintStats(constraint) for constraint in constraints]
+
+    def __repr__(self):
+        return '<CommandStats %s: %d scanned, %d passed, %.6fs>' % (
+            self.name, self.scanned, self.passed, self.time
+        )
+
+
+class InstrumentedConstraint(object):
+    """
+    Constraint proxy recording evaluations of the constraint it wraps
+    """
+
+    def __init__(self, constraint, stats):
+        self.constraint = constraint
+        self.stats = stats
+        self.SELECTIVITY = constraint.SELECTIVITY
+        self.REORDERABLE = constraint.REORDERABLE
+
+    def get_cost(self):
+        return self.constraint.get_cost()
+
+    def describe(self):
+        return self.constraint.describe()
+
+    def fits(self, item):
+        started = default_timer()
+        result = self.constraint.fits(item)
+        self.stats.time += default_timer() - started
+        self.stats.evaluations += 1
+        if result:
+            self.stats.passed += 1
+        return result
+
+
+def instrument_test(test, stats):
+    def instrumented_test(item):
+        started = default_timer()
+        result = test(item)
+        stats.time += default_timer() - started
+        stats.scanned += 1
+        if result:
+            stats.passed += 1
+        return result
+    return instrumented_test
+
+
+def instrument_iterator(iterator, stats, reported=()):
+    """
+    Yields items of `iterator`, recording time spent producing them.
+    Stats (along with `reported` ones) are sent to hooks once
+    the iteration is over or abandoned.
+    """
+    iterator = iter(iterator)
+    try:
+        while True:
+            started = default_timer()
+            try:
+                item = next(iterator)
+            finally:
+                stats.time += default_timer() - started
+            stats.passed += 1
+            yield item
+    except StopIteration:
+        return
+    finally:
+        for command_stats in reported:
+            notify(command_stats)
+        notify(stats)
+
+
+def count_items(iterable, stats):
+    for item in iterable:
+        stats.scanned += 1
+        yield item
+
+
+def timed(function, stats):
+    started = default_timer()
+    try:
+        return function()
+    finally:
+        stats.time += default_timer() - started
+        notify(stats)
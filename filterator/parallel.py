@@ -0,0 +1,202 @@
+import multiprocessing
+from Queue import Queue
+from collections import deque
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+from planner import ConstraintsPlan
+
+
+__all__ = (
+    'Parallelism',
+    'ChunkFilter',
+    'ChunkMap',
+    'MethodCall',
+    'BatchCall',
+)
+
+
+class Parallelism(object):
+    """
+    Settings for evaluating filtering chains and invoke() calls
+    over a pool of workers. The iterable is split into chunks which are
+    processed concurrently and merged back in their original order
+    (or, for invoke() with `ordered` off, as they complete).
+    Process pools need constraints and invoked functions to be picklable,
+    so callables must be module-level functions.
+    """
+
+    PENDING_CHUNKS_PER_WORKER = 2
+
+    def __init__(self, workers=None, chunk_size=1000, threads=False, ordered=True):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.ordered = ordered
+
+    def create_pool(self):
+        if self.threads:
+            return ThreadPool(self.workers)
+        return multiprocessing.Pool(self.workers)
+
+    def filter(self, filtered, iterable):
+        chunks = iter_chunks(iterable, self.chunk_size)
+        for chunk, positions in self.map_chunks(ChunkFilter(filtered.commands), chunks):
+            for position in positions:
+                yield chunk[position]
+
+    def map(self, function, iterable):
+        chunks = iter_chunks(iterable, self.chunk_size)
+        for _, results in self.map_chunks(ChunkMap(function), chunks, self.ordered):
+            for result in results:
+                yield result
+
+    def map_batches(self, function, batches):
+        for _, results in self.map_chunks(function, batches, self.ordered):
+            yield results
+
+    def map_chunks(self, function, chunks, ordered=True):
+        """
+        Yields (chunk, function(chunk)) pairs, keeping a bounded number
+        of chunks pending, either in order of chunks or as they complete
+        """
+        pool = self.create_pool()
+        try:
+            max_pending = self.workers * self.PENDING_CHUNKS_PER_WORKER
+            if ordered:
+                results = self.map_ordered(pool, function, chunks, max_pending)
+            else:
+                results = self.map_completed(pool, function, chunks, max_pending)
+            for pair in results:
+                yield pair
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def map_ordered(self, pool, function, chunks, max_pending):
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(function, (chunk,))))
+            if len(pending) > max_pending:
+                chunk, result = pending.popleft()
+                yield chunk, result.get()
+        while pending:
+            chunk, result = pending.popleft()
+            yield chunk, result.get()
+
+    def map_completed(self, pool, function, chunks, max_pending):
+        # Callbacks only run for calls that succeed,
+        # so failures are returned by CapturedCall rather than raised
+        completed = Queue()
+        function = CapturedCall(function)
+        pending = 0
+        for chunk in chunks:
+            pool.apply_async(
+                function, (chunk,),
+                callback=lambda outcome, chunk=chunk: completed.put((chunk, outcome))
+            )
+            pending += 1
+            if pending > max_pending:
+                pending -= 1
+                yield self.take_completed(completed)
+        while pending:
+            pending -= 1
+            yield self.take_completed(completed)
+
+    def take_completed(self, completed):
+        chunk, (succeeded, result) = completed.get()
+        if not succeeded:
+            raise result
+        return chunk, result
+
+    def describe(self):
+        return 'Evaluate in %d %s, %d items per chunk%s' % (
+            self.workers,
+            'threads' if self.threads else 'processes',
+            self.chunk_size,
+            '' if self.ordered else ', invoke() results as completed'
+        )
+
+
+class ChunkFilter(object):
+    """
+    Picklable counterpart of a FilteredIterable's commands,
+    returning positions of chunk items that pass all of them
+    """
+
+    def __init__(self, commands):
+        self.specs = [
+            (command.constraints, command.REJECTS_WHEN_FITS) for command in commands
+        ]
+
+    def __call__(self, chunk):
+        tests = [self.get_test(constraints, rejects_when_fits) for constraints, rejects_when_fits in self.specs]
+        return [
+            position for position, item in enumerate(chunk)
+            if all(test(item) for test in tests)
+        ]
+
+    def get_test(self, constraints, rejects_when_fits):
+        return ConstraintsPlan(constraints, rejects_when_fits).get_test()
+
+
+class ChunkMap(object):
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, chunk):
+        return map(self.function, chunk)
+
+
+class CapturedCall(object):
+    """
+    Returns a (succeeded, result or exception) pair instead of raising
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args):
+        try:
+            return True, self.function(*args)
+        except Exception as e:
+            return False, e
+
+
+class MethodCall(object):
+    """
+    Picklable counterpart of operator.methodcaller
+    """
+
+    def __init__(self, method_name, args=(), kwargs=None):
+        self.method_name = method_name
+        self.args = args
+        self.kwargs = kwargs or {}
+
+    def __call__(self, item):
+        return getattr(item, self.method_name)(*self.args, **self.kwargs)
+
+
+class BatchCall(object):
+    """
+    Calls `function` once per batch of items, expecting a result per item.
+    A name stands for a classmethod or staticmethod of the items' class.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, batch):
+        function = self.function
+        if isinstance(function, basestring):
+            function = getattr(batch[0].__class__, function)
+        return list(function(batch))
+
+
+def iter_chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,100 @@
+from compiler import compile_predicate
+
+
+class ConstraintsPlan(object):
+    """
+    Evaluates a set of constraints in the order that is expected
+    to decide about an item cheapest.
+
+    Constraints are ranked by their cost divided by the probability of
+    deciding (rejecting the item) on their own. The probability starts
+    from the constraint's static SELECTIVITY and is refined by pass rates
+    observed on a sample of items. Callable constraints aren't reordered:
+    they keep their given order and are evaluated after the lookups.
+    As constraints may guard others (e.g. a callable checking the type
+    of an item before a lookup), an item on which the reordered ones
+    raise is evaluated again in the given order before the error
+    is propagated.
+    """
+
+    SAMPLING_INTERVAL = 16
+    REORDERING_INTERVAL = 8
+    PRIOR_WEIGHT = 4
+    MIN_DECISION_RATE = 0.001
+
+    def __init__(self, constraints, rejects_when_fits=False):
+        self.constraints = list(constraints)
+        self.rejects_when_fits = rejects_when_fits
+        self.evaluations = [0] * len(self.constraints)
+        self.passes = [0] * len(self.constraints)
+        self.samples = 0
+        self.reorderable = [
+            index for index, constraint in enumerate(self.constraints) if constraint.REORDERABLE
+        ]
+        self.fixed = [
+            index for index, constraint in enumerate(self.constraints) if not constraint.REORDERABLE
+        ]
+        self.countdown = 1
+        self.declared = compile_predicate(self.constraints, rejects_when_fits)
+        self.reorder()
+
+    def reorder(self):
+        ranks = dict((index, self.get_rank(index)) for index in self.reorderable)
+        self.order = sorted(self.reorderable, key=ranks.__getitem__) + self.fixed
+        self.predicate = compile_predicate(self.get_ordered_constraints(), self.rejects_when_fits)
+
+    def get_rank(self, index):
+        constraint = self.constraints[index]
+        pass_rate = (
+            (self.passes[index] + self.PRIOR_WEIGHT * constraint.SELECTIVITY) /
+            float(self.evaluations[index] + self.PRIOR_WEIGHT)
+        )
+        decision_rate = pass_rate if self.rejects_when_fits else 1 - pass_rate
+        return constraint.get_cost() / max(decision_rate, self.MIN_DECISION_RATE)
+
+    def get_test(self):
+        if len(self.reorderable) >= 2:
+            return self.test
+        if self.order == range(len(self.constraints)):
+            return self.predicate
+        return self.evaluate
+
+    def get_ordered_constraints(self):
+        return [self.constraints[index] for index in self.order]
+
+    def test(self, item):
+        self.countdown -= 1
+        # Threads sharing the plan may step past zero together
+        if self.countdown <= 0:
+            return self.sample(item)
+        return self.evaluate(item)
+
+    def evaluate(self, item):
+        try:
+            return self.predicate(item)
+        except Exception:
+            return self.declared(item)
+
+    def sample(self, item):
+        """
+        Evaluates constraints like the predicate does, stopping at the first
+        one that decides, and records pass rates of those evaluated
+        """
+        self.countdown = self.SAMPLING_INTERVAL
+        self.samples += 1
+        try:
+            passed = self.record(item)
+        except Exception:
+            passed = self.declared(item)
+        if not self.samples % self.REORDERING_INTERVAL:
+            self.reorder()
+        return passed
+
+    def record(self, item):
+        for index in self.order:
+            fits = bool(self.constraints[index].fits(item))
+            self.evaluations[index] += 1
+            self.passes[index] += fits
+            if fits == self.rejects_when_fits:
+                return False
+        return True
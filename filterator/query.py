@@ -0,0 +1,488 @@
+from collections import OrderedDict, namedtuple
+from itertools import chain, ifilter, imap, islice
+
+from compiler import compile_projection
+from indexes import find_index, select_positions
+from instrumentation import hooks, CommandStats, count_items, instrument_iterator
+from utils import get_accessor
+
+
+class LazyIterable(object):
+    """
+    Base class for query plan nodes.
+    Nothing is evaluated until the node is iterated, counted or indexed,
+    and every evaluation makes a fresh pass over the source.
+    """
+
+    def __iter__(self):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.get_slice(key)
+        return self.get_item(key)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def get_item(self, index):
+        if index < 0:
+            return list(self)[index]
+        for item in islice(self, index, None):
+            return item
+        raise IndexError('Index out of range')
+
+    def get_slice(self, key):
+        if self.is_negative_slice(key):
+            return list(self)[key]
+        return list(islice(self, key.start, key.stop, key.step))
+
+    def is_negative_slice(self, key):
+        for value in (key.start, key.stop, key.step):
+            if value is not None and value < 0:
+                return True
+        return False
+
+    def limit(self, count):
+        return LimitedIterable(self, count)
+
+    def explain(self):
+        """
+        Returns lines describing how the node would be evaluated
+        """
+        raise NotImplementedError
+
+
+def explain_iterable(iterable):
+    if isinstance(iterable, LazyIterable):
+        return iterable.explain()
+    if isinstance(iterable, (list, tuple)):
+        return ['Scan %s of %d items' % (iterable.__class__.__name__, len(iterable))]
+    return ['Scan %s' % iterable.__class__.__name__]
+
+
+class LimitedIterable(LazyIterable):
+    def __init__(self, source, count):
+        self.source = source
+        self.count = count
+
+    def __iter__(self):
+        return islice(self.source, self.count)
+
+    def explain(self):
+        return explain_iterable(self.source) + ['Limit to %d items' % self.count]
+
+
+class FilteredIterable(LazyIterable):
+    """
+    Chain of filtering commands applied to a single source.
+    Consecutive filter() and exclude() calls are merged into one node,
+    so the whole chain is evaluated in a single pass.
+    """
+
+    def __init__(self, source, commands, indexes=(), parallelism=None):
+        self.source = source
+        self.commands = commands
+        self.indexes = indexes
+        self.parallelism = parallelism
+
+    def chain(self, command):
+        return self.__class__(self.source, self.commands + [command], self.indexes, self.parallelism)
+
+    def __iter__(self):
+        if self.parallelism is not None:
+            iterator = self.parallelism.filter(self, self.get_candidates())
+            if hooks:
+                return instrument_iterator(iterator, CommandStats('ParallelFilter'))
+            return iterator
+        if hooks:
+            return self.iter_instrumented()
+        return ifilter(self.get_test(), self.get_candidates())
+
+    def iter_instrumented(self):
+        stats = CommandStats(self.__class__.__name__)
+        commands_stats = [
+            CommandStats(command.__class__.__name__, command.plan.get_ordered_constraints())
+            for command in self.commands
+        ]
+        tests = [
+            command.get_instrumented_test(command_stats)
+            for command, command_stats in zip(self.commands, commands_stats)
+        ]
+        candidates = count_items(self.get_candidates(), stats)
+        return instrument_iterator(
+            ifilter(self.combine_tests(tests), candidates),
+            stats,
+            commands_stats
+        )
+
+    def explain(self):
+        lines = explain_iterable(self.source)
+        for constraint in self.get_indexable_constraints():
+            index = find_index(self.indexes, constraint)
+            if index is not None:
+                lines.append('Look up %s in %s on %s' % (constraint.describe(), index.__class__.__name__, index.name))
+        for command in self.commands:
+            lines.append('%s: %s' % (command.__class__.__name__, ', '.join(
+                '%s (cost %s)' % (constraint.describe(), constraint.get_cost())
+                for constraint in command.plan.get_ordered_constraints()
+            )))
+        if self.parallelism is not None:
+            lines.append(self.parallelism.describe())
+        return lines
+
+    def after(self, cursor):
+        """
+        Returns the chain over the ordering it filters resumed after `cursor`
+        """
+        return self.__class__(self.source.after(cursor), self.commands, self.indexes, self.parallelism)
+
+    def get_cursor(self, item):
+        return self.source.get_cursor(item)
+
+    def get_candidates(self):
+        if self.indexes:
+            positions = select_positions(self.indexes, self.get_indexable_constraints())
+            if positions is not None:
+                source = self.source
+                return (source[position] for position in positions)
+        return self.source
+
+    def get_indexable_constraints(self):
+        constraints = []
+        for command in self.commands:
+            constraints.extend(command.get_indexable_constraints())
+        return constraints
+
+    def get_test(self):
+        return self.combine_tests([command.get_test() for command in self.commands])
+
+    def combine_tests(self, tests):
+        if len(tests) == 1:
+            return tests[0]
+
+        def passes_all_tests(item):
+            for test in tests:
+                if not test(item):
+                    return False
+            return True
+        return passes_all_tests
+
+
+class OrderedIterable(LazyIterable):
+    """
+    Ordering of a source. When only the first `count` items are needed
+    (after limit(), slicing or indexing), they are selected with a bounded
+    heap in O(n log count) instead of sorting the whole source.
+    With a `cursor` (attributes of the ordering keys), only items coming
+    after it are ordered. Given a SortedIndex on the ordering key,
+    a limited or resumed ordering walks the index instead,
+    testing items in order until enough of them pass.
+    """
+
+    def __init__(self, source, strategy, streaming=None, count=None, cursor=None, index=None):
+        self.source = source
+        self.strategy = strategy
+        self.streaming = streaming
+        self.count = count
+        self.cursor = cursor
+        self.index = index
+
+    def __iter__(self):
+        if self.is_index_walked():
+            iterator = self.iter_indexed()
+            if hooks:
+                return instrument_iterator(iterator, CommandStats('IndexOrder'))
+            return iterator
+        if hooks:
+            return self.iter_instrumented()
+        return self.iter_ordered(self.strategy)
+
+    def is_index_walked(self):
+        return self.index is not None and (self.count is not None or self.cursor is not None)
+
+    def iter_ordered(self, strategy):
+        if self.cursor is not None:
+            strategy = strategy.after(self.cursor)
+        if self.count is not None:
+            return iter(strategy.get_top(self.count))
+        if self.streaming is not None:
+            return self.streaming.sort(strategy)
+        return iter(strategy.get_ordered_iterable())
+
+    def iter_indexed(self):
+        items, test = self.source, None
+        if isinstance(items, FilteredIterable):
+            items, test = items.source, items.get_test()
+        ordered = (
+            items[position]
+            for position in self.index.iter_positions(self.strategy.is_reversed(), self.cursor)
+        )
+        if test is not None:
+            ordered = ifilter(test, ordered)
+        return islice(ordered, self.count)
+
+    def iter_instrumented(self):
+        stats = CommandStats(self.strategy.__class__.__name__)
+        strategy = self.strategy.__class__(count_items(self.strategy.iterable, stats), self.strategy.keys)
+        return instrument_iterator(self.iter_ordered(strategy), stats)
+
+    def explain(self):
+        lines = explain_iterable(self.source)
+        lines.append('Order by %s using %s' % (', '.join(self.strategy.keys), self.strategy.__class__.__name__))
+        if self.cursor is not None:
+            lines.append('Start after %r' % (tuple(self.cursor),))
+        if self.is_index_walked():
+            lines.append('Walk %s on %s in order' % (self.index.__class__.__name__, self.index.name))
+            if self.count is not None:
+                lines.append('Stop after %d items' % self.count)
+        elif self.count is not None:
+            lines.append('Select top %d items with a bounded heap' % self.count)
+        elif self.streaming is not None:
+            lines.append('Sort externally, %d items per run' % self.streaming.sort_buffer_size)
+        return lines
+
+    def limit(self, count):
+        if self.count is not None:
+            count = min(count, self.count)
+        return self.__class__(self.source, self.strategy, self.streaming, count, self.cursor, self.index)
+
+    def after(self, cursor):
+        """
+        Returns the ordering of items coming after `cursor`,
+        which replaces any cursor given before
+        """
+        return self.__class__(self.source, self.strategy, self.streaming, self.count, tuple(cursor), self.index)
+
+    def get_cursor(self, item):
+        """
+        Returns the cursor pointing right after `item`
+        """
+        return self.strategy.get_attributes(item)
+
+    def get_item(self, index):
+        if index < 0:
+            return super(OrderedIterable, self).get_item(index)
+        items = list(self.limit(index + 1))
+        if len(items) <= index:
+            raise IndexError('Index out of range')
+        return items[index]
+
+    def get_slice(self, key):
+        if self.is_negative_slice(key) or key.stop is None:
+            return super(OrderedIterable, self).get_slice(key)
+        return list(islice(self.limit(key.stop), key.start, None, key.step))
+
+
+class GroupedIterable(LazyIterable):
+    """
+    Items of a source grouped by values of `names`, in order of first
+    appearance. Groups are iterated as (key, items) pairs, where the key
+    is a tuple of values when there are several names. Once aggregated,
+    groups are iterated as dicts of key values and aggregate results,
+    computed in a single pass keeping only a state per group.
+    """
+
+    def __init__(self, source, names, aggregation=None):
+        self.source = source
+        self.names = names
+        self.aggregation = aggregation
+
+    def aggregate(self, aggregation):
+        return self.__class__(self.source, self.names, aggregation)
+
+    def __iter__(self):
+        if self.aggregation is None:
+            return self.iter_groups()
+        return self.iter_aggregated()
+
+    def iter_groups(self):
+        groups = OrderedDict()
+        get_key = self.get_key_function()
+        for item in self.source:
+            key = get_key(item)
+            try:
+                groups[key].append(item)
+            except KeyError:
+                groups[key] = [item]
+        return groups.iteritems()
+
+    def iter_aggregated(self):
+        groups = OrderedDict()
+        get_key = self.get_key_function()
+        aggregation = self.aggregation
+        for item in self.source:
+            key = get_key(item)
+            try:
+                states = groups[key]
+            except KeyError:
+                states = groups[key] = aggregation.start()
+            aggregation.add(states, item)
+        for key, states in groups.iteritems():
+            row = aggregation.finish(states)
+            row.update(zip(self.names, key if len(self.names) > 1 else (key,)))
+            yield row
+
+    def get_key_function(self):
+        return get_projection(self.names, flat=len(self.names) == 1)
+
+    def explain(self):
+        lines = explain_iterable(self.source)
+        lines.append('Group by %s' % ', '.join(self.names))
+        if self.aggregation is not None:
+            lines.append('Aggregate %s in a single pass' % self.aggregation.describe())
+        return lines
+
+
+class ProjectedIterable(LazyIterable):
+    """
+    Values of `names` resolved on items of a source, as dicts
+    or, when `as_dicts` is false, as tuples (single values if `flat`)
+    """
+
+    def __init__(self, source, names, as_dicts=True, flat=False):
+        self.source = source
+        self.names = names
+        self.as_dicts = as_dicts
+        self.flat = flat
+
+    def __iter__(self):
+        if self.as_dicts:
+            names = self.names
+            project = get_projection(names)
+            return (dict(zip(names, project(item))) for item in self.source)
+        return imap(get_projection(self.names, self.flat), self.source)
+
+    def limit(self, count):
+        source = self.source
+        if isinstance(source, LazyIterable):
+            source = source.limit(count)
+        else:
+            source = LimitedIterable(source, count)
+        return self.__class__(source, self.names, self.as_dicts, self.flat)
+
+    def explain(self):
+        return explain_iterable(self.source) + ['Project %s' % ', '.join(self.names)]
+
+
+def get_projection(names, flat=False):
+    """
+    Returns a function resolving values of `names` on an item,
+    either as a tuple or, if `flat`, as the single value of the only name
+    """
+    if flat:
+        return get_accessor(names[0])
+    return compile_projection(names)
+
+
+Joined = namedtuple('Joined', 'left right')
+
+# A page of ordered items. `cursor` resumes the ordering after its last item
+# and is None when there are no more items
+Page = namedtuple('Page', 'items cursor has_next')
+
+
+class JoinedIterable(LazyIterable):
+    """
+    Hash join of a source with another iterable on values of a pair
+    of paths. Inner joins yield Joined(left, right) pairs for every match,
+    building the hash table from the smaller side when both sizes are known.
+    Pairs come in order of source items, then of their matches, whichever
+    side is hashed. Semi and anti joins yield source items which have
+    (or lack) a match. None keys never match.
+    """
+
+    HOWS = ('inner', 'semi', 'anti')
+
+    def __init__(self, source, other, keys, how='inner'):
+        self.source = source
+        self.other = other
+        self.keys = keys
+        self.how = how
+
+    def __iter__(self):
+        left_key, right_key = map(get_accessor, self.keys)
+        if self.how != 'inner':
+            table = HashTable(self.other, right_key)
+            keep = self.how == 'semi'
+            return (item for item in self.source if (left_key(item) in table) == keep)
+        if self.builds_on_source():
+            return self.join_on_source(left_key, right_key)
+        table = HashTable(self.other, right_key)
+        return (
+            Joined(item, match)
+            for item in self.source for match in table.get(left_key(item))
+        )
+
+    def join_on_source(self, left_key, right_key):
+        """
+        Hashes positions of source items, collects matches of each one
+        while scanning the other side, then yields them in source order
+        """
+        items = list(self.source)
+        table = HashTable(xrange(len(items)), lambda position: left_key(items[position]))
+        matches = {}
+        for other_item in self.other:
+            for position in table.get(right_key(other_item)):
+                matches.setdefault(position, []).append(other_item)
+        for position in sorted(matches):
+            item = items[position]
+            for match in matches[position]:
+                yield Joined(item, match)
+
+    def builds_on_source(self):
+        try:
+            return len(self.source) < len(self.other)
+        except TypeError:
+            return False
+
+    def explain(self):
+        left, right = self.keys
+        lines = explain_iterable(self.source)
+        lines.append('Hash %s join on %s = %s, building on the %s side' % (
+            self.how, left, right, 'source' if self.how == 'inner' and self.builds_on_source() else 'other'
+        ))
+        return lines
+
+
+class HashTable(object):
+    """
+    Items grouped by their join keys, other than None. Items with
+    unhashable keys (such as lists) are grouped in a list compared
+    to every key looked up, and keys which can't be hashed are compared
+    to all keys one by one.
+    """
+
+    def __init__(self, items, get_key):
+        self.buckets = {}
+        self.unhashable = []
+        for item in items:
+            key = get_key(item)
+            if key is None:
+                continue
+            try:
+                self.buckets.setdefault(key, []).append(item)
+            except TypeError:
+                self.add_unhashable(key, item)
+
+    def add_unhashable(self, key, item):
+        for other_key, items in self.unhashable:
+            if other_key == key:
+                items.append(item)
+                return
+        self.unhashable.append((key, [item]))
+
+    def get(self, key):
+        try:
+            matches = self.buckets.get(key, ())
+        except TypeError:
+            return self.find(key, chain(self.buckets.iteritems(), self.unhashable))
+        if not self.unhashable:
+            return matches
+        return list(matches) + self.find(key, self.unhashable)
+
+    def find(self, key, groups):
+        return [item for other_key, items in groups if other_key == key for item in items]
+
+    def __contains__(self, key):
+        return bool(self.get(key))
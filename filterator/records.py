@@ -0,0 +1,173 @@
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+from filterator import Filterable
+from utils import get_accessor
+
+
+__all__ = (
+    'RecordFormat',
+    'RecordFile',
+    'RecordFilterable',
+    'open_records',
+)
+
+
+class RecordFormat(object):
+    """
+    Layout of fixed-width binary records: a list of (name, struct format)
+    pairs, e.g. [('age', 'i'), ('score', 'd'), ('name', '16s')].
+    Strings are padded with NUL bytes, which are stripped when they are read.
+    """
+
+    RESERVED_NAMES = ('buffer', 'offset', 'format', 'decode')
+
+    def __init__(self, fields, byte_order='<'):
+        self.fields = list(fields)
+        self.names = [name for name, _ in self.fields]
+        for name in self.names:
+            if name in self.RESERVED_NAMES:
+                raise ValueError('%r is reserved for MappedRecord attributes' % name)
+        self.struct = struct.Struct(byte_order + ''.join(code for _, code in self.fields))
+        self.size = self.struct.size
+        self.tuple_class = namedtuple('Record', self.names)
+        self.record_class = self.build_record_class(byte_order)
+
+    def build_record_class(self, byte_order):
+        attributes = {'__slots__': (), 'format': self}
+        codes = ''
+        for name, code in self.fields:
+            # Native layouts may pad the field to align it
+            offset = struct.calcsize(byte_order + codes + code) - struct.calcsize(byte_order + code)
+            attributes[name] = field_property(struct.Struct(byte_order + code), offset, code.endswith('s'))
+            codes += code
+        return type('MappedRecord', (MappedRecord,), attributes)
+
+    def pack(self, item):
+        return self.struct.pack(*[get_accessor(name)(item) for name in self.names])
+
+    def unpack(self, buffer, offset):
+        values = self.struct.unpack_from(buffer, offset)
+        return self.tuple_class(*[
+            value.rstrip('\0') if isinstance(value, str) else value for value in values
+        ])
+
+    def write(self, path, items):
+        """
+        Writes values of the format's fields resolved on `items` to a file
+        """
+        with open(path, 'wb') as f:
+            for item in items:
+                f.write(self.pack(item))
+
+
+def field_property(field_struct, field_offset, is_string):
+    unpack_from = field_struct.unpack_from
+
+    if is_string:
+        def get_value(record):
+            value, = unpack_from(record.buffer, record.offset + field_offset)
+            return value.rstrip('\0')
+    else:
+        def get_value(record):
+            value, = unpack_from(record.buffer, record.offset + field_offset)
+            return value
+    return property(get_value)
+
+
+class MappedRecord(object):
+    """
+    View of a record within a mapped file. Fields are decoded from
+    the buffer each time they are accessed, so a query only decodes
+    fields it looks at. decode() builds a namedtuple of all of them.
+    """
+
+    __slots__ = ('buffer', 'offset')
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+
+    def decode(self):
+        return self.format.unpack(self.buffer, self.offset)
+
+    def __eq__(self, other):
+        if isinstance(other, MappedRecord):
+            return self.decode() == other.decode()
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return '<MappedRecord %r>' % (self.decode(),)
+
+
+class RecordFile(object):
+    """
+    Sequence of records stored in a file in a RecordFormat, read through mmap.
+    Opening a file reads nothing, and items are MappedRecord views,
+    so scanning keeps memory use independent of the file size.
+    """
+
+    def __init__(self, path, record_format):
+        self.format = record_format
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+        self.count = size // record_format.size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        record_class, buffer = self.format.record_class, self.buffer
+        for offset in xrange(0, self.count * self.format.size, self.format.size):
+            yield record_class(buffer, offset)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[position] for position in xrange(*key.indices(self.count))]
+        if key < 0:
+            key += self.count
+        if not 0 <= key < self.count:
+            raise IndexError('Record index out of range')
+        return self.format.record_class(self.buffer, key * self.format.size)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+class RecordFilterable(Filterable):
+    """
+    Filterable over a RecordFile, which close() (or leaving a with block)
+    unmaps. Records read from it can't be used afterwards.
+    """
+
+    def __init__(self, iterable):
+        super(RecordFilterable, self).__init__(iterable)
+        self.records = iterable if isinstance(iterable, RecordFile) else None
+
+    def close(self):
+        if self.records is not None:
+            self.records.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_records(path, fields, byte_order='<'):
+    """
+    Returns a RecordFilterable over records of a file written with
+    RecordFormat(fields, byte_order).write()
+    """
+    return RecordFilterable(RecordFile(path, RecordFormat(fields, byte_order)))
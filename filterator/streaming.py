@@ -0,0 +1,82 @@
+import cPickle as pickle
+import heapq
+import tempfile
+from itertools import islice
+
+
+__all__ = (
+    'Streaming',
+    'SinglePassIterable',
+)
+
+
+class Streaming(object):
+    """
+    Settings for Filterables over iterables that may not fit in memory.
+    Results are produced by generators, and ordering keeps at most
+    `sort_buffer_size` items in memory, spilling sorted runs to temporary
+    files which are merged afterwards.
+    """
+
+    def __init__(self, sort_buffer_size=100000):
+        self.sort_buffer_size = sort_buffer_size
+
+    def sort(self, strategy):
+        runs = []
+        iterator = iter(strategy.iterable)
+        while True:
+            chunk = list(islice(iterator, self.sort_buffer_size))
+            ordered = strategy.__class__(chunk, strategy.keys).get_ordered_iterable()
+            if not runs and len(chunk) < self.sort_buffer_size:
+                return iter(ordered)
+            if not chunk:
+                return self.merge(runs, strategy.get_comparison_key())
+            runs.append(self.spill(ordered))
+
+    def spill(self, items):
+        run = tempfile.TemporaryFile()
+        pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+        for item in items:
+            pickler.dump(item)
+            pickler.clear_memo()
+        run.seek(0)
+        return run
+
+    def merge(self, runs, key):
+        try:
+            decorated = [self.decorate(self.load(run), key, number) for number, run in enumerate(runs)]
+            for _, _, _, item in heapq.merge(*decorated):
+                yield item
+        finally:
+            for run in runs:
+                run.close()
+
+    def decorate(self, items, key, run_number):
+        for position, item in enumerate(items):
+            yield key(item), run_number, position, item
+
+    def load(self, run):
+        unpickler = pickle.Unpickler(run)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+
+
+class SinglePassIterable(object):
+    """
+    Iterator given as the source of a streaming Filterable. Queries make
+    a pass over their source each time they are evaluated, so a second
+    one raises instead of finding the iterator exhausted.
+    """
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.consumed = False
+
+    def __iter__(self):
+        if self.consumed:
+            raise ValueError('Iterators can be queried only once, stream a sequence to query it again')
+        self.consumed = True
+        return self.iterator
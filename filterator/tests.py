@@ -1,9 +1,28 @@
+import os
 import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest2
 from collections import namedtuple
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from errors import MultipleValuesReturned
+from aggregates import Avg, Count, Max, Min, Sum
+from asynchronous import AsyncFilterable
+from commands import FilterCommand
+from compiler import compile_predicate, compile_projection
+from constraints import CallableConstraint, ConstraintsFactory
 from filterator import Filterable
+from instrumentation import add_hook, remove_hook, hooks, profile
+from planner import ConstraintsPlan
+from query import Page
+from utils import get_accessor, resolve_value
 
 
 class Person(namedtuple('Person', 'name age sex children vehicle')):
@@ -18,10 +37,18 @@ class Person(namedtuple('Person', 'name age sex children vehicle')):
             return self.vehicle.manufacturer
         return default
 
+    @classmethod
+    def get_names(cls, people):
+        return [person.name for person in people]
+
 
 Vehicle = namedtuple('Vehicle', 'type manufacturer')
 
 
+def is_even(number):
+    return number % 2 == 0
+
+
 class FilteratorTestCase(unittest2.TestCase):
     def setUp(self):
         self.car = Vehicle('car', 'ford')
@@ -52,6 +79,25 @@ class TestFilter(FilteratorTestCase):
         self.assertItemsEqual([self.bob], mature_men)
         self.assertItemsEqual([self.joe, self.bob], men)
 
+    def test_deep_path_with_lookup(self):
+        self.assertEqual([self.bob], self.people.filter(vehicle__type__startswith='c'))
+        self.assertEqual([self.alice], self.people.filter(vehicle__manufacturer__iendswith='BIKES'))
+        self.assertEqual([self.marta, self.joe, self.alice], self.people.exclude(vehicle__type__contains='ar'))
+
+    def test_lookups_are_parsed_once(self):
+        self.assertIs(
+            ConstraintsFactory.parse_lookup('vehicle__type__regex'),
+            ConstraintsFactory.parse_lookup('vehicle__type__regex')
+        )
+        self.assertEqual(
+            ('vehicle__type', ConstraintsFactory.KEYWORD_TO_CONSTRAINT_CLASS_MAP['regex']),
+            ConstraintsFactory.parse_lookup('vehicle__type__regex')
+        )
+        self.assertEqual(
+            ('vehicle__type', ConstraintsFactory.DEFAULT_CONSTRAINT_CLASS),
+            ConstraintsFactory.parse_lookup('vehicle__type')
+        )
+
     def test_filter_by_string(self):
         self.assertItemsEqual([self.bob], self.people.filter(name='Bob'))
 
@@ -79,6 +125,35 @@ class TestFilter(FilteratorTestCase):
     def test_filter_iendswith(self):
         self.assertItemsEqual([self.bob], self.people.filter(name__iendswith='OB'))
 
+    def test_filter_icontains(self):
+        self.assertItemsEqual([self.marta, self.alice], self.people.filter(name__icontains='A'))
+
+    def test_filter_in_prefixes(self):
+        self.assertItemsEqual([self.joe, self.bob], self.people.filter(name__in_prefixes=['Jo', 'B', 'Bo']))
+
+    def test_filter_icontains_any(self):
+        self.assertItemsEqual(
+            [self.joe, self.alice, self.bob],
+            self.people.filter(name__icontains_any=['OE', 'ic', 'b', 'a.'])
+        )
+        self.assertEqual([], self.people.filter(name__icontains_any=[]))
+        self.assertEqual([], self.people.filter(name__icontains_any=[], sex='M'))
+
+    def test_filter_in_unhashable_values(self):
+        self.assertEqual([self.marta, self.joe], self.people.filter(children__in=[[], [self.joe]]))
+        self.assertEqual([self.alice], self.people.filter(children__in=[1, [self.marta]]))
+        self.assertEqual([self.alice, self.bob], self.people.exclude(children__in=(2, [])))
+
+    def test_filter_in(self):
+        self.assertItemsEqual([self.joe, self.alice], self.people.filter(name__in=['Joe', 'Alice', 'Moe']))
+        self.assertItemsEqual([self.marta, self.bob], self.people.exclude(age__in=set([7, 23])))
+
+    def test_filter_in_unhashable(self):
+        self.assertItemsEqual([self.marta, self.joe], self.people.filter(children__in=[[], [self.joe]]))
+
+    def test_filter_range(self):
+        self.assertItemsEqual([self.joe, self.alice], self.people.filter(age__range=(7, 23)))
+
     def test_filter_regex(self):
         self.assertItemsEqual([self.alice, self.bob], self.people.filter(name__regex='^[AB].*$'))
 
@@ -182,6 +257,10 @@ class TestSum(FilteratorTestCase):
     def test(self):
         self.assertEqual(63, self.people.sum('age'))
 
+    def test_deep(self):
+        stats = Filterable([{'stats': {'score': 3}}, {'stats': {'score': 4}}])
+        self.assertEqual(7, stats.sum('stats__score'))
+
 
 class TestExists(FilteratorTestCase):
     def test_exists(self):
@@ -190,6 +269,29 @@ class TestExists(FilteratorTestCase):
     def test_does_not_exists(self):
         self.assertEqual(False, self.people.filter(name='Cris').exists())
 
+    def test_exists_with_constraints(self):
+        self.assertEqual(True, self.people.exists(name='Bob'))
+
+
+class TestFirstAndLast(FilteratorTestCase):
+    def test_first(self):
+        self.assertEqual(self.marta, self.people.first())
+
+    def test_first_with_constraints(self):
+        self.assertEqual(self.alice, self.people.first(sex='F', age__gt=2))
+
+    def test_first_of_empty(self):
+        self.assertIsNone(self.people.filter(age=200).first())
+
+    def test_last(self):
+        self.assertEqual(self.bob, self.people.last())
+
+    def test_last_with_constraints(self):
+        self.assertEqual(self.alice, self.people.last(lambda p: p.sex == 'F'))
+
+    def test_last_of_empty(self):
+        self.assertIsNone(self.people.last(age=200))
+
 
 class TestOrdering(FilteratorTestCase):
     class Creature(namedtuple('Creature', 'name number_of_legs number_of_eyes')):
@@ -239,6 +341,73 @@ class TestOrdering(FilteratorTestCase):
         self.assertEqual([self.dog, self.human, self.spider], self.creatures.order_by('get_name'))
 
 
+class TestMixedOrdering(FilteratorTestCase):
+    class Counted(namedtuple('Counted', 'group score')):
+        calls = []
+
+        def get_score(self):
+            self.calls.append(self)
+            return self.score
+
+    def setUp(self):
+        self.Counted.calls = []
+        self.items = [self.Counted(group, score) for group, score in [(1, 5), (2, 1), (1, 7), (2, 1), (1, 5)]]
+
+    def test_stable_mixed_order(self):
+        self.assertEqual(
+            [self.items[2], self.items[0], self.items[4], self.items[1], self.items[3]],
+            Filterable(self.items).order_by('group', '-score')
+        )
+
+    def test_keys_resolved_once_per_item(self):
+        list(Filterable(self.items).order_by('-group', 'get_score'))
+        self.assertEqual(len(self.items), len(self.Counted.calls))
+
+    def test_top_matches_full_sort(self):
+        ordered = Filterable(self.items).order_by('-group', 'score')
+        self.assertEqual(list(ordered)[:3], ordered[:3])
+
+
+class TestTopOrdering(FilteratorTestCase):
+    def setUp(self):
+        Creature = TestOrdering.Creature
+        self.dog = Creature(name='dog', number_of_legs=4, number_of_eyes=2)
+        self.spider = Creature(name='spider', number_of_legs=8, number_of_eyes=9000)
+        self.human = Creature(name='human', number_of_legs=2, number_of_eyes=2)
+        self.cat = Creature(name='cat', number_of_legs=4, number_of_eyes=2)
+        self.creatures = Filterable([self.dog, self.human, self.spider, self.cat])
+
+    def test_slice(self):
+        self.assertEqual([self.human, self.dog], self.creatures.order_by('number_of_legs')[:2])
+
+    def test_slice_with_offset(self):
+        self.assertEqual([self.dog, self.cat], self.creatures.order_by('number_of_legs')[1:3])
+
+    def test_ties_keep_original_order(self):
+        self.assertEqual([self.dog, self.human, self.cat], self.creatures.order_by('number_of_eyes')[:3])
+
+    def test_reversed_ties_keep_original_order(self):
+        self.assertEqual([self.spider, self.dog, self.cat], self.creatures.order_by('-number_of_legs')[:3])
+
+    def test_mixed_directions(self):
+        self.assertEqual([self.spider, self.human], self.creatures.order_by('-number_of_eyes', 'number_of_legs')[:2])
+
+    def test_limit(self):
+        self.assertEqual([self.spider], self.creatures.order_by('-number_of_legs').limit(1))
+        self.assertEqual([self.dog, self.human], self.creatures.limit(2))
+
+    def test_index(self):
+        self.assertEqual(self.cat, self.creatures.order_by('number_of_legs')[2])
+        self.assertEqual(self.spider, self.creatures.order_by('number_of_legs')[-1])
+        with self.assertRaises(IndexError):
+            self.creatures.order_by('name')[4]
+
+    def test_does_not_sort(self):
+        ordered = self.creatures.order_by('name')
+        ordered.iterable.strategy.get_ordered_iterable = None
+        self.assertEqual([self.cat, self.dog], ordered[:2])
+
+
 class TestInvoke(FilteratorTestCase):
     def test_no_arguments(self):
         self.assertEqual(
@@ -258,6 +427,1087 @@ class TestInvoke(FilteratorTestCase):
             self.people.invoke('get_vehicle_manufacturer', default='foo')
         )
 
+    def test_invoke_batched(self):
+        self.assertEqual(['Marta', 'Joe', 'Alice', 'Bob'], self.people.invoke_batched(Person.get_names, batch_size=3))
+        self.assertEqual(['Joe', 'Bob'], self.people.filter(sex='M').invoke_batched('get_names'))
+
+    def test_invoke_batched_calls_once_per_batch(self):
+        batches = []
+        self.people.invoke_batched(lambda batch: batches.append(batch) or batch, batch_size=3)
+        self.assertEqual([[self.marta, self.joe, self.alice], [self.bob]], batches)
+
+
+class TestAccessors(FilteratorTestCase):
+    def test_accessors_are_shared(self):
+        self.assertIs(get_accessor('vehicle__type'), get_accessor('vehicle__type'))
+
+    def test_namedtuple_field(self):
+        self.assertEqual('Bob', resolve_value(self.bob, 'name'))
+
+    def test_deep_path(self):
+        self.assertEqual('ford', resolve_value(self.bob, 'vehicle__manufacturer'))
+
+    def test_none_in_path(self):
+        self.assertIsNone(resolve_value(self.joe, 'vehicle__manufacturer'))
+
+    def test_method(self):
+        self.assertEqual(True, resolve_value(self.bob, 'is_car_driver'))
+
+    def test_dict(self):
+        self.assertEqual('ford', resolve_value({'vehicle': {'manufacturer': 'ford'}}, 'vehicle__manufacturer'))
+
+    def test_plain_object(self):
+        class Plain(object):
+            def __init__(self, vehicle):
+                self.vehicle = vehicle
+        self.assertEqual('car', resolve_value(Plain(self.car), 'vehicle__type'))
+
+    def test_filter_dicts(self):
+        people = Filterable([{'name': 'Bob', 'age': 31}, {'name': 'Alice', 'age': 23}])
+        self.assertEqual([{'name': 'Alice', 'age': 23}], people.filter(age__lt=30))
+
+
+class TestIndexes(FilteratorTestCase):
+    def setUp(self):
+        super(TestIndexes, self).setUp()
+        self.calls = []
+
+    def spy(self, person):
+        self.calls.append(person)
+        return True
+
+    def test_hash_index_exact(self):
+        self.people.create_index('name')
+        self.assertEqual([self.bob], self.people.filter(self.spy, name='Bob'))
+        self.assertEqual([self.bob], self.calls)
+
+    def test_hash_index_deep(self):
+        self.people.create_index('vehicle__type')
+        self.assertEqual([self.alice], self.people.filter(vehicle__type='bicycle'))
+
+    def test_hash_index_iexact(self):
+        self.people.create_index('name')
+        self.assertEqual([self.bob], self.people.filter(name__iexact='BOB'))
+
+    def test_hash_index_isnull(self):
+        self.people.create_index('vehicle')
+        self.assertEqual([self.marta, self.joe], self.people.filter(vehicle__isnull=False))
+
+    def test_sorted_index_range(self):
+        self.people.create_index('age', kind='sorted')
+        self.assertEqual(
+            [self.joe, self.alice],
+            self.people.filter(self.spy, age__gte=7, age__lt=31)
+        )
+        self.assertEqual([self.joe, self.alice], self.calls)
+
+    def test_sorted_index_gt_and_lte(self):
+        self.people.create_index('age', kind='sorted')
+        self.assertEqual([self.alice], self.people.filter(age__gt=7, age__lte=23))
+
+    def test_sorted_index_startswith(self):
+        self.people.create_index('name', kind='sorted')
+        self.assertEqual([self.marta], self.people.filter(name__startswith='Ma'))
+        self.assertEqual([self.alice], self.people.filter(name__istartswith='al'))
+
+    def test_sorted_index_in_prefixes(self):
+        self.people.create_index('name', kind='sorted')
+        self.assertEqual([self.marta, self.bob], self.people.filter(self.spy, name__in_prefixes=('Ma', 'B')))
+        self.assertEqual([self.marta, self.bob], self.calls)
+
+    def test_hash_index_in(self):
+        self.people.create_index('name')
+        self.assertEqual([self.joe, self.alice], self.people.filter(self.spy, name__in=['Alice', 'Joe', 'Moe']))
+        self.assertEqual([self.joe, self.alice], self.calls)
+
+    def test_sorted_index_in_and_range(self):
+        self.people.create_index('age', kind='sorted')
+        self.assertEqual([self.marta, self.bob], self.people.filter(age__in=(31, 2, 40)))
+        self.assertEqual([self.joe, self.alice], self.people.filter(self.spy, age__range=(3, 30)))
+        self.assertEqual([self.joe, self.alice], self.calls)
+
+    def test_folded_index(self):
+        self.people.create_index('name', kind='folded')
+        self.assertEqual([self.bob], self.people.filter(self.spy, name__iexact='bOB'))
+        self.assertEqual([self.bob], self.calls)
+        self.assertEqual([self.marta, self.alice], self.people.filter(name__icontains_any=['RT', 'LI']))
+        self.assertEqual([], self.people.filter(name__icontains_any=[]))
+        self.assertEqual([self.joe], self.people.filter(name__iendswith='OE'))
+
+    def test_folded_index_is_updated(self):
+        self.people.create_index('name', kind='folded')
+        moe = Person('Moe', 40, 'M', [], None)
+        self.people.append(moe)
+        self.assertEqual([self.joe, moe], self.people.filter(name__icontains='oe'))
+
+    def test_indexes_combined_with_exclude(self):
+        self.people.create_index('sex')
+        self.assertEqual([self.joe], self.people.filter(sex='M').exclude(age__gt=18))
+
+    def test_unindexed_constraints_still_apply(self):
+        self.people.create_index('sex')
+        self.assertEqual([self.alice], self.people.filter(sex='F', age__gt=18))
+
+
+class TestConstraintsPlan(FilteratorTestCase):
+    def build_constraint(self, name, value):
+        return ConstraintsFactory(name, value).get_constraint()
+
+    def test_cheap_constraints_go_first(self):
+        callable_constraint = CallableConstraint(lambda p: True)
+        exact = self.build_constraint('sex', 'M')
+        plan = ConstraintsPlan([callable_constraint, exact])
+        self.assertEqual([exact, callable_constraint], plan.get_ordered_constraints())
+
+    def test_selective_constraints_go_first(self):
+        gt = self.build_constraint('age__gt', 0)
+        exact = self.build_constraint('name', 'Bob')
+        plan = ConstraintsPlan([gt, exact])
+        self.assertEqual([exact, gt], plan.get_ordered_constraints())
+
+    def test_excluding_constraints_that_fit_more_often_go_first(self):
+        exact = self.build_constraint('name', 'Bob')
+        gt = self.build_constraint('age__gt', 0)
+        plan = ConstraintsPlan([exact, gt], rejects_when_fits=True)
+        self.assertEqual([gt, exact], plan.get_ordered_constraints())
+
+    def test_reordering_by_observed_pass_rates(self):
+        usually_fits = self.build_constraint('kind', 'common')
+        rarely_fits = self.build_constraint('number__gt', 900)
+        plan = ConstraintsPlan([rarely_fits, usually_fits])
+        self.assertEqual([usually_fits, rarely_fits], plan.get_ordered_constraints())
+        items = [{'kind': 'common' if n % 10 else 'rare', 'number': n} for n in xrange(1000)]
+        self.assertEqual(90, len(filter(plan.get_test(), items)))
+        self.assertEqual([rarely_fits, usually_fits], plan.get_ordered_constraints())
+
+    def test_callables_keep_their_order(self):
+        first = CallableConstraint(lambda item: item['number'] % 10 == 0)
+        second = CallableConstraint(lambda item: item['number'] % 10 != 0)
+        exact = self.build_constraint('kind', 'common')
+        plan = ConstraintsPlan([first, exact, second])
+        items = [{'kind': 'common', 'number': n} for n in xrange(1000)]
+        self.assertEqual(0, len(filter(plan.get_test(), items)))
+        self.assertEqual([exact, first, second], plan.get_ordered_constraints())
+
+    def test_sampling_resumes_after_countdown_overshoots(self):
+        plan = ConstraintsPlan([self.build_constraint('age__gt', 0), self.build_constraint('sex', 'M')])
+        plan.countdown = -3
+        plan.get_test()(self.bob)
+        self.assertEqual(1, plan.samples)
+        self.assertEqual(ConstraintsPlan.SAMPLING_INTERVAL, plan.countdown)
+
+    def test_callables_guarding_lookups(self):
+        Named = namedtuple('Named', 'name')
+        bob = Named('Bob')
+        self.assertEqual(
+            [bob] * 20,
+            Filterable([bob, 42] * 20).filter(lambda item: isinstance(item, Named), name__startswith='B')
+        )
+        items = Filterable([bob, 42, Named(7)] * 20)
+        has_string_name = lambda item: isinstance(getattr(item, 'name', None), basestring)
+        self.assertEqual([bob] * 20, items.filter(has_string_name, name__startswith='B', name__endswith='b'))
+        self.assertEqual([bob] * 20, items.exclude(lambda item: not has_string_name(item), name__gt='C'))
+        with self.assertRaises(AttributeError):
+            list(items.filter(lambda item: item.name, name='Bob'))
+
+    def test_guard_callables(self):
+        people = Filterable([Person('Walker', 40, 'M', [], None), self.bob] * 20)
+        self.assertEqual(
+            [self.bob] * 20,
+            people.filter(lambda p: p.vehicle is not None, lambda p: p.vehicle.type == 'car', age__gt=0)
+        )
+        self.assertEqual(
+            [self.bob] * 20,
+            people.exclude(lambda p: p.vehicle is None, lambda p: p.vehicle.type != 'car', sex='F')
+        )
+
+    def test_results_are_not_affected(self):
+        self.assertItemsEqual(
+            [self.bob],
+            self.people.filter(lambda p: len(p.name) == 3, sex='M', age__gt=18)
+        )
+        self.assertItemsEqual(
+            [self.marta],
+            self.people.exclude(lambda p: len(p.name) == 3, age__gt=18)
+        )
+
+
+class TestCompiledPredicates(FilteratorTestCase):
+    def build_constraints(self, **kwargs):
+        return [ConstraintsFactory(name, value).get_constraint() for name, value in kwargs.items()]
+
+    def test_all_fit(self):
+        predicate = compile_predicate(self.build_constraints(sex='M', name__istartswith='b'))
+        self.assertEqual([self.bob], filter(predicate, self.people))
+
+    def test_none_fit(self):
+        predicate = compile_predicate(self.build_constraints(sex='M', age__lt=18), rejects_when_fits=True)
+        self.assertEqual([self.alice], filter(predicate, self.people))
+
+    def test_callables(self):
+        predicate = compile_predicate([CallableConstraint(lambda p: p.age > 30)])
+        self.assertEqual([self.bob], filter(predicate, self.people))
+
+    def test_no_constraints(self):
+        self.assertTrue(compile_predicate([])(self.bob))
+
+    def test_factories_are_shared_by_query_shape(self):
+        first = compile_predicate(self.build_constraints(name='Bob'))
+        second = compile_predicate(self.build_constraints(name='Moe'))
+        self.assertIs(first.func_code, second.func_code)
+        self.assertNotEqual(first(self.bob), second(self.bob))
+
+    def test_commands_and_constraints_have_no_dict(self):
+        command = FilterCommand(self.people, list(self.people), sex='M')
+        self.assertFalse(hasattr(command, '__dict__'))
+        self.assertFalse(hasattr(command.constraints[0], '__dict__'))
+
+
+class Owner(object):
+    def __init__(self, name, vehicle):
+        self.name = name
+        self.vehicle_accesses = 0
+        self._vehicle = vehicle
+
+    @property
+    def vehicle(self):
+        self.vehicle_accesses += 1
+        return self._vehicle
+
+
+class TestSharedPaths(FilteratorTestCase):
+    def setUp(self):
+        super(TestSharedPaths, self).setUp()
+        self.owners = [Owner(person.name, person.vehicle) for person in self.people]
+
+    def get_accesses(self):
+        return [owner.vehicle_accesses for owner in self.owners]
+
+    def test_constraints_share_prefixes(self):
+        owners = Filterable(self.owners).filter(vehicle__type='car', vehicle__manufacturer__startswith='f')
+        self.assertEqual(['Bob'], [owner.name for owner in owners])
+        # The first item is sampled by the planner, which checks constraints one by one
+        self.assertEqual([1, 1, 1], self.get_accesses()[1:])
+
+    def test_ordering_keys_share_prefixes(self):
+        owners = Filterable(self.owners).order_by('vehicle__type', '-vehicle__manufacturer')
+        self.assertEqual(['Marta', 'Joe', 'Alice', 'Bob'], [owner.name for owner in owners])
+        self.assertEqual([1, 1, 1, 1], self.get_accesses())
+
+    def test_projection_resolves_like_accessors(self):
+        names = ['vehicle__type', 'vehicle__manufacturer', 'is_car_driver', 'vehicle', 'name']
+        project = compile_projection(names)
+        for person in self.people:
+            self.assertEqual(tuple(get_accessor(name)(person) for name in names), project(person))
+
+    def test_results_are_not_affected(self):
+        self.assertEqual(
+            [self.alice],
+            self.people.filter(vehicle__type__in=['bicycle', 'car'], vehicle__manufacturer__iendswith='BIKES')
+        )
+        self.assertEqual([self.bob], self.people.exclude(vehicle__isnull=False, vehicle__type='bicycle'))
+
+
+@unittest2.skipIf(numpy is None, 'numpy is not installed')
+class TestColumnarFilterable(FilteratorTestCase):
+    def setUp(self):
+        super(TestColumnarFilterable, self).setUp()
+        from columnar import ColumnarFilterable
+        self.people = ColumnarFilterable(self.people)
+
+    def test_group_by(self):
+        self.assertEqual(
+            [{'sex': 'F', 'total': 25}, {'sex': 'M', 'total': 38}],
+            self.people.group_by('sex').aggregate(total=Sum('age'))
+        )
+
+    def test_in_and_range(self):
+        self.assertEqual([self.joe, self.bob], self.people.filter(name__in=['Bob', 'Joe']))
+        self.assertEqual([self.joe, self.alice], self.people.filter(age__range=(7, 30)))
+
+    def test_exact(self):
+        self.assertEqual([self.bob], self.people.filter(name='Bob'))
+
+    def test_comparisons(self):
+        self.assertEqual([self.joe, self.alice], self.people.filter(age__gte=7, age__lt=31))
+
+    def test_string_lookups(self):
+        self.assertEqual([self.joe, self.bob], self.people.filter(name__contains='o'))
+        self.assertEqual([self.marta], self.people.filter(name__startswith='Ma'))
+        self.assertEqual([self.alice], self.people.filter(name__endswith='ice'))
+
+    def test_isnull(self):
+        self.assertEqual([self.alice, self.bob], self.people.filter(children__isnull=True))
+
+    def test_exclude(self):
+        self.assertEqual([self.marta], self.people.exclude(sex='M', age=23))
+        self.assertEqual(list(self.people), self.people.exclude())
+
+    def test_fallbacks(self):
+        self.assertEqual([self.bob], self.people.filter(lambda p: p.age > 18, vehicle__type='car'))
+        self.assertEqual([self.alice], self.people.filter(name__iexact='ALICE'))
+
+    def test_chaining(self):
+        self.assertEqual([self.alice], self.people.filter(sex='F').exclude(age__lt=18))
+
+    def test_order_by(self):
+        self.assertEqual([self.bob, self.alice, self.joe, self.marta], self.people.order_by('-age'))
+        self.assertEqual([self.marta, self.alice, self.joe, self.bob], self.people.order_by('sex', '-name'))
+
+    def test_order_by_method(self):
+        self.assertEqual([self.marta, self.joe, self.alice, self.bob], self.people.order_by('is_car_driver', 'age'))
+
+    def test_aggregates(self):
+        self.assertEqual(63, self.people.sum('age'))
+        self.assertEqual(2, self.people.filter(sex='M').count())
+
+    def test_terminal_commands(self):
+        self.assertEqual(self.bob, self.people.get(name='Bob'))
+        self.assertEqual(self.alice, self.people.filter(sex='F').last())
+        self.assertTrue(self.people.exists(age__gt=30))
+        self.assertEqual([False, False, False, True], self.people.invoke('is_car_driver'))
+
+    def test_pagination(self):
+        page = self.people.order_by('sex', '-age').paginate(3)
+        self.assertEqual(Page([self.alice, self.marta, self.bob], ('M', 31), True), page)
+        self.assertEqual(Page([self.joe], None, False), self.people.order_by('sex', '-age').paginate(3, page.cursor))
+        self.assertEqual([self.joe, self.bob], self.people.order_by('age').after((2,)).filter(sex='M'))
+        self.assertEqual([self.bob], self.people.order_by('age').filter(sex='M').after((7,)))
+        with self.assertRaises(ValueError):
+            self.people.paginate(2)
+
+    def test_mutations_are_rejected(self):
+        dave = Person('Dave', 40, 'M', [], None)
+        for mutate in (
+            lambda: self.people.append(dave),
+            lambda: self.people.remove(self.bob),
+            lambda: self.people.update(self.bob, dave),
+            lambda: self.people.view(sex='M'),
+        ):
+            with self.assertRaises(TypeError):
+                mutate()
+        self.assertEqual(4, self.people.count())
+        self.assertEqual([self.bob], self.people.filter(name='Bob'))
+
+    def test_indexes_are_rejected(self):
+        with self.assertRaises(TypeError):
+            self.people.create_index('age')
+
+
+class TestParallel(FilteratorTestCase):
+    def setUp(self):
+        super(TestParallel, self).setUp()
+        self.numbers = Filterable(range(1000))
+
+    def test_processes(self):
+        result = self.numbers.parallel(workers=2, chunk_size=64).filter(is_even, real__lt=100)
+        self.assertEqual(range(0, 100, 2), list(result))
+
+    def test_processes_with_lookups(self):
+        people = self.people.parallel(workers=2, chunk_size=1)
+        self.assertEqual([self.bob], people.filter(sex='M').exclude(name__startswith='J'))
+
+    def test_threads(self):
+        result = self.numbers.parallel(workers=4, chunk_size=10, threads=True).exclude(lambda n: n % 3)
+        self.assertEqual(range(0, 1000, 3), list(result))
+
+    def test_short_circuit(self):
+        numbers = self.numbers.parallel(workers=2, chunk_size=10, threads=True)
+        self.assertEqual(500, numbers.filter(is_even).first(lambda n: n >= 500))
+
+    def test_setting_survives_chaining(self):
+        numbers = self.numbers.parallel(workers=2, threads=True).order_by('-real')
+        self.assertIsNotNone(numbers.filter(is_even).parallelism)
+
+    def test_invoke(self):
+        people = self.people.parallel(workers=2, chunk_size=1)
+        self.assertEqual([True, False, False, False], people.invoke('is_age_dividable_by', 2))
+
+    def test_invoke_as_completed(self):
+        numbers = self.numbers.parallel(workers=4, chunk_size=10, threads=True, ordered=False)
+        self.assertItemsEqual(range(1, 1001), numbers.invoke('__add__', 1))
+
+    def test_invoke_as_completed_raises(self):
+        numbers = self.numbers.parallel(workers=4, chunk_size=10, threads=True, ordered=False)
+        with self.assertRaises(ZeroDivisionError):
+            numbers.invoke('__rdiv__', 1)
+
+    def test_invoke_batched(self):
+        people = self.people.parallel(workers=2, chunk_size=1, ordered=False)
+        self.assertItemsEqual(['Marta', 'Joe', 'Alice', 'Bob'], people.invoke_batched('get_names', batch_size=3))
+
+
+class TestAsyncFilterable(FilteratorTestCase):
+    def setUp(self):
+        super(TestAsyncFilterable, self).setUp()
+        self.tested = []
+        self.lock = threading.Lock()
+
+    def slow_is_even(self, number):
+        with self.lock:
+            self.tested.append(number)
+        time.sleep(0.01 * (number % 3))
+        return number % 2 == 0
+
+    def test_keeps_order(self):
+        numbers = AsyncFilterable(range(30), concurrency=8)
+        self.assertEqual(range(0, 30, 2), list(numbers.filter(self.slow_is_even)))
+
+    def test_predicates_overlap(self):
+        numbers = AsyncFilterable(range(30), concurrency=30)
+        started = time.time()
+        list(numbers.filter(lambda n: time.sleep(0.05) or True))
+        self.assertLess(time.time() - started, 0.05 * 10)
+
+    def test_lookups_and_chaining(self):
+        people = AsyncFilterable(self.people, concurrency=2)
+        self.assertEqual([self.bob], people.filter(sex='M').exclude(name__startswith='J'))
+        self.assertIsInstance(people.order_by('age').filter(sex='F').parallelism, type(people.parallelism))
+
+    def test_terminal_commands(self):
+        numbers = AsyncFilterable(range(30), concurrency=4)
+        self.assertEqual(15, numbers.filter(self.slow_is_even).count())
+        self.assertTrue(numbers.exists(self.slow_is_even))
+        self.assertEqual(3, numbers.first(lambda n: n > 2))
+        self.assertEqual(4, numbers.get(lambda n: n == 4))
+
+    def test_short_circuit(self):
+        numbers = AsyncFilterable(xrange(100000), concurrency=4)
+        self.assertEqual(0, numbers.first(self.slow_is_even))
+        self.assertLess(len(self.tested), 100)
+
+    def test_invoke(self):
+        numbers = AsyncFilterable(range(30), concurrency=8)
+        self.assertEqual(range(0, 60, 2), numbers.invoke('__mul__', 2))
+
+    def test_explain(self):
+        self.assertIn('concurrently', AsyncFilterable(range(3), concurrency=4).filter(is_even).explain())
+
+
+class TestStreaming(FilteratorTestCase):
+    def setUp(self):
+        super(TestStreaming, self).setUp()
+        self.items = list(self.people) * 5
+        self.stream = Filterable(iter(self.items)).stream(sort_buffer_size=3)
+
+    def test_external_sort(self):
+        self.assertEqual(sorted(self.items, key=lambda p: p.age), list(self.stream.order_by('age')))
+
+    def test_external_sort_reversed(self):
+        self.assertEqual(
+            sorted(self.items, key=lambda p: (p.sex, p.age), reverse=True),
+            list(self.stream.order_by('-sex', '-age'))
+        )
+
+    def test_external_sort_mixed(self):
+        self.assertEqual(
+            sorted(self.items, key=lambda p: (p.sex, -p.age)),
+            list(self.stream.order_by('sex', '-age'))
+        )
+
+    def test_filter_and_sort(self):
+        self.assertEqual([self.bob] * 5, list(self.stream.filter(sex='M').order_by('-age')[:5]))
+
+    def test_invoke_returns_generator(self):
+        results = self.stream.invoke('is_car_driver')
+        self.assertFalse(isinstance(results, list))
+        self.assertEqual(5, sum(results))
+
+    def test_count_and_sum(self):
+        self.assertEqual(10, self.stream.filter(sex='F').count())
+        self.assertEqual(0, Filterable(iter([])).stream().count())
+
+    def test_iterator_is_queried_once(self):
+        self.assertEqual(10, self.stream.filter(sex='F').count())
+        with self.assertRaises(ValueError):
+            self.stream.filter(sex='M').count()
+
+    def test_generator_source(self):
+        numbers = Filterable(xrange(10 ** 6)).stream()
+        self.assertEqual(999999, numbers.filter(real__gt=999998).get())
+
+
+class TestResultCache(FilteratorTestCase):
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        self.people.enable_cache(maxsize=2)
+
+    def test_hits_and_misses(self):
+        self.assertEqual([self.bob], self.people.filter(sex='M', age__gt=18))
+        self.assertEqual([self.bob], self.people.filter(age__gt=18, sex='M'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 2}, self.people.cache_info())
+
+    def test_chains_are_cached(self):
+        self.people.enable_cache()
+        self.people.filter(sex='F').order_by('-age').first()
+        self.assertEqual(self.alice, self.people.filter(sex='F').order_by('-age').first())
+        self.assertEqual(2, self.people.cache_info()['hits'])
+
+    def test_terminal_commands_are_cached(self):
+        self.assertEqual(2, self.people.filter(sex='M').count())
+        self.assertEqual(2, self.people.filter(sex='M').count())
+        self.assertEqual(2, self.people.cache_info()['hits'])
+
+    def test_unhashable_arguments(self):
+        self.assertEqual([self.marta, self.joe], self.people.filter(children=[]))
+        self.assertEqual([self.marta, self.joe], self.people.filter(children=[]))
+        self.assertEqual(1, self.people.cache_info()['hits'])
+
+    def test_lru_eviction(self):
+        self.people.filter(sex='M')
+        self.people.filter(sex='F')
+        self.people.filter(sex='M')
+        self.people.filter(age=2)
+        self.people.filter(sex='F')
+        self.assertEqual({'hits': 1, 'misses': 4, 'size': 2, 'maxsize': 2}, self.people.cache_info())
+
+    def test_ttl(self):
+        self.people.enable_cache(ttl=-1)
+        self.people.filter(sex='M')
+        self.people.filter(sex='M')
+        self.assertEqual(0, self.people.cache_info()['hits'])
+
+    def test_invalidation_on_mutation(self):
+        self.assertEqual(2, self.people.filter(sex='M').count())
+        dave = Person('Dave', 40, 'M', [], None)
+        self.people.append(dave)
+        self.assertEqual([self.joe, self.bob, dave], self.people.filter(sex='M'))
+        self.people.remove(self.joe)
+        self.assertEqual([self.bob, dave], self.people.filter(sex='M'))
+        self.assertEqual(0, self.people.cache_info()['hits'])
+
+    def test_pagination(self):
+        self.people.enable_cache()
+        for _ in xrange(2):
+            page = self.people.order_by('age').paginate(2)
+            self.assertEqual(Page([self.marta, self.joe], (7,), True), page)
+            self.assertEqual([self.alice, self.bob], self.people.order_by('age').after(page.cursor))
+            self.assertIn('Order by age', self.people.order_by('age').explain())
+        self.assertEqual(1, self.people.cache_info()['hits'])
+
+    def test_hits_are_copies(self):
+        dave = Person('Dave', 0, 'M', [], None)
+        adults = self.people.filter(age__gte=2)
+        same_adults = self.people.filter(age__gte=2)
+        adults.append(dave)
+        self.assertEqual([self.marta, self.joe, self.alice, self.bob], same_adults)
+        page = self.people.order_by('age').paginate(2)
+        page.items.append(dave)
+        self.assertEqual([self.marta, self.joe], self.people.order_by('age').paginate(2).items)
+        self.people.aggregate(total=Sum('age'))['total'] = 0
+        self.assertEqual({'total': 63}, self.people.aggregate(total=Sum('age')))
+
+    def test_invoke_is_not_cached(self):
+        self.people.invoke('is_car_driver')
+        self.assertEqual(0, self.people.cache_info()['size'])
+
+
+class TestAggregation(FilteratorTestCase):
+    def test_aggregate(self):
+        self.assertEqual(
+            {'total': 63, 'average': 15.75, 'youngest': 2, 'oldest': 31, 'people': 4},
+            self.people.aggregate(
+                total=Sum('age'), average=Avg('age'), youngest=Min('age'), oldest=Max('age'), people=Count()
+            )
+        )
+
+    def test_aggregate_is_single_pass(self):
+        items = CountingIterable(self.people)
+        Filterable(items).aggregate(total=Sum('age'), oldest=Max('age'))
+        self.assertEqual(1, items.passes)
+
+    def test_aggregate_follows_paths_and_skips_none(self):
+        self.assertEqual(
+            {'drivers': 2, 'first': 'ford'},
+            self.people.aggregate(drivers=Count('vehicle__type'), first=Min('vehicle__manufacturer'))
+        )
+
+    def test_aggregate_empty(self):
+        self.assertEqual(
+            {'total': 0, 'average': None, 'oldest': None},
+            self.people.filter(age__gt=100).aggregate(total=Sum('age'), average=Avg('age'), oldest=Max('age'))
+        )
+
+    def test_group_by(self):
+        self.assertEqual(
+            [{'sex': 'F', 'people': 2, 'oldest': 23}, {'sex': 'M', 'people': 2, 'oldest': 31}],
+            list(self.people.group_by('sex').aggregate(people=Count(), oldest=Max('age')))
+        )
+
+    def test_group_by_several_names(self):
+        self.assertEqual(
+            [
+                {'sex': 'F', 'vehicle__type': None, 'people': 1},
+                {'sex': 'M', 'vehicle__type': None, 'people': 1},
+                {'sex': 'F', 'vehicle__type': 'bicycle', 'people': 1},
+                {'sex': 'M', 'vehicle__type': 'car', 'people': 1},
+            ],
+            self.people.group_by('sex', 'vehicle__type').aggregate(people=Count())
+        )
+
+    def test_group_by_without_aggregates(self):
+        self.assertEqual(
+            [('F', [self.marta, self.alice]), ('M', [self.joe, self.bob])],
+            list(self.people.group_by('sex'))
+        )
+
+    def test_aggregates_are_hashable_by_value(self):
+        self.people.enable_cache()
+        self.people.aggregate(total=Sum('age'))
+        self.people.aggregate(total=Sum('age'))
+        self.assertEqual(1, self.people.cache_info()['hits'])
+
+    def test_values(self):
+        self.assertEqual(
+            [{'name': 'Alice', 'vehicle__type': 'bicycle'}, {'name': 'Bob', 'vehicle__type': 'car'}],
+            self.people.filter(age__gt=18).values('name', 'vehicle__type')
+        )
+
+    def test_values_list(self):
+        self.assertEqual([('Joe', 7), ('Bob', 31)], self.people.filter(sex='M').values_list('name', 'age'))
+        self.assertEqual(['Bob', 'Alice'], self.people.order_by('-age').values_list('name', flat=True)[:2])
+
+    def test_flat_values_list_of_several_names(self):
+        with self.assertRaises(TypeError):
+            self.people.values_list('name', 'age', flat=True)
+
+
+class TestMutations(FilteratorTestCase):
+    def setUp(self):
+        super(TestMutations, self).setUp()
+        self.dave = Person('Dave', 40, 'M', [], None)
+
+    def test_indexes_are_updated(self):
+        self.people.create_index('sex')
+        self.people.create_index('age', kind='sorted')
+        self.people.extend([self.dave])
+        self.assertEqual([self.joe, self.bob, self.dave], self.people.filter(sex='M'))
+        self.assertEqual([self.bob, self.dave], self.people.filter(age__gt=30))
+        self.people.remove(self.bob)
+        self.assertEqual([self.dave], self.people.filter(age__gt=30))
+        self.assertEqual([self.joe, self.dave], self.people.filter(sex='M'))
+
+    def test_lazy_results_see_mutations(self):
+        men = self.people.filter(sex='M')
+        self.people.append(self.dave)
+        self.assertEqual([self.joe, self.bob, self.dave], men)
+
+    def test_indexed_tuple(self):
+        people = Filterable((self.bob, self.joe, self.marta, self.alice))
+        people.create_index('sex')
+        men = people.filter(sex='M')
+        people.remove(self.bob)
+        self.assertEqual([self.joe], men)
+
+
+class TestViews(FilteratorTestCase):
+    def setUp(self):
+        super(TestViews, self).setUp()
+        self.dave = Person('Dave', 40, 'M', [], None)
+        self.kid = Person('Kid', 7, 'M', [], None)
+
+    def test_view(self):
+        men = self.people.view(sex='M', order_by='-age')
+        self.assertEqual([self.bob, self.joe], list(men))
+        self.assertEqual(2, len(men))
+
+    def test_view_is_maintained(self):
+        men = self.people.view(sex='M', order_by=('age', 'name'))
+        self.people.append(self.dave)
+        self.people.append(self.kid)
+        self.people.append(Person('Eve', 30, 'F', [], None))
+        self.assertEqual([self.joe, self.kid, self.bob, self.dave], list(men))
+        self.people.remove(self.bob)
+        self.assertEqual([self.joe, self.kid, self.dave], list(men))
+        self.people.update(self.joe, self.joe._replace(age=50))
+        self.assertEqual([self.kid, self.dave, self.joe._replace(age=50)], list(men))
+        self.assertEqual(self.people.filter(sex='M').order_by('age', 'name'), list(men))
+
+    def test_view_only_tests_changed_items(self):
+        tested = []
+        everyone = self.people.view(lambda person: tested.append(person) or True)
+        del tested[:]
+        self.people.append(self.dave)
+        self.assertEqual([self.dave], tested)
+        self.assertEqual(5, len(everyone))
+
+    def test_unordered_view_keeps_insertion_order(self):
+        adults = self.people.view(age__gte=18)
+        self.people.append(self.dave)
+        self.assertEqual([self.alice, self.bob, self.dave], list(adults))
+        self.people.remove(self.alice)
+        self.assertEqual([self.bob, self.dave], list(adults))
+
+    def test_update_keeps_position(self):
+        adults = self.people.view(age__gte=18)
+        by_sex = self.people.view(order_by='sex')
+        older_alice = self.alice._replace(age=24)
+        self.people.update(self.alice, older_alice)
+        self.assertEqual(self.people.filter(age__gte=18), list(adults))
+        self.assertEqual(self.people.order_by('sex'), list(by_sex))
+        self.people.update(self.joe, self.joe._replace(age=18))
+        self.assertEqual(self.people.filter(age__gte=18), list(adults))
+        self.assertEqual([self.joe._replace(age=18), older_alice, self.bob], list(adults))
+
+    def test_copies_keep_views_and_cache_up_to_date(self):
+        self.people.enable_cache()
+        men = self.people.view(sex='M')
+        self.assertEqual(2, self.people.filter(sex='M').count())
+        self.people.parallel(threads=True).append(self.dave)
+        self.people.stream().append(self.kid)
+        self.assertEqual([self.joe, self.bob, self.dave, self.kid], list(men))
+        self.assertEqual(4, self.people.filter(sex='M').count())
+
+    def test_unreferenced_views_are_dropped(self):
+        self.people.view(sex='M')
+        men = self.people.view(sex='M')
+        self.assertEqual([men], list(self.people.views))
+
+    def test_reading_a_view(self):
+        by_age = self.people.view(order_by='-age')
+        self.assertEqual(self.bob, by_age[0])
+        self.assertEqual([self.bob, self.alice], by_age[:2])
+        self.assertEqual([self.bob], Filterable(by_age).filter(sex='M', age__gt=18))
+
+
+class TestRecords(FilteratorTestCase):
+    FIELDS = [('name', '8s'), ('age', 'i'), ('sex', 'c'), ('score', 'd')]
+
+    def setUp(self):
+        super(TestRecords, self).setUp()
+        from records import RecordFormat, open_records
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'people.bin')
+        Scored = namedtuple('Scored', 'name age sex score')
+        self.rows = [Scored(person.name, person.age, person.sex, person.age / 10.0) for person in self.people]
+        RecordFormat(self.FIELDS).write(self.path, self.rows)
+        self.records = open_records(self.path, self.FIELDS)
+
+    def tearDown(self):
+        self.records.close()
+        shutil.rmtree(self.directory)
+
+    def decode(self, records):
+        return [record.decode() for record in records]
+
+    def test_fields(self):
+        record = self.records[3]
+        self.assertEqual(('Bob', 31, 'M', 3.1), (record.name, record.age, record.sex, record.score))
+        self.assertEqual(4, self.records.count())
+
+    def test_filter_and_order(self):
+        self.assertEqual(['Bob'], [record.name for record in self.records.filter(sex='M', name__endswith='ob')])
+        self.assertEqual(
+            [('Bob', 31, 'M', 3.1), ('Alice', 23, 'F', 2.3)],
+            self.decode(self.records.order_by('-score').exclude(age__lt=18))
+        )
+
+    def test_aggregate_and_values(self):
+        self.assertEqual({'oldest': 31}, self.records.aggregate(oldest=Max('age')))
+        self.assertEqual(['Marta', 'Alice'], self.records.filter(sex='F').values_list('name', flat=True))
+
+    def test_decode(self):
+        self.assertEqual(self.rows[1], self.records.get(name='Joe').decode())
+        self.assertEqual(self.records[-1], self.records.last())
+
+    def test_empty_file(self):
+        from records import RecordFormat, open_records
+        path = os.path.join(self.directory, 'empty.bin')
+        RecordFormat(self.FIELDS).write(path, [])
+        self.assertEqual([], list(open_records(path, self.FIELDS).filter(age__gt=0)))
+
+    def test_native_alignment(self):
+        from records import RecordFormat, open_records
+        path = os.path.join(self.directory, 'aligned.bin')
+        fields = [('flag', 'b'), ('age', 'i'), ('sex', 'c'), ('score', 'd')]
+        RecordFormat(fields, '@').write(path, [{'flag': 1, 'age': 100, 'sex': 'M', 'score': 0.5}])
+        with open_records(path, fields, '@') as records:
+            record = records[0]
+            self.assertEqual((1, 100, 'M', 0.5), (record.flag, record.age, record.sex, record.score))
+            self.assertEqual([record], records.filter(age=100, score__gt=0))
+
+    def test_reserved_names(self):
+        from records import RecordFormat
+        with self.assertRaises(ValueError):
+            RecordFormat([('offset', 'i')])
+
+
+class TestJoins(FilteratorTestCase):
+    def setUp(self):
+        super(TestJoins, self).setUp()
+        Manufacturer = namedtuple('Manufacturer', 'name country')
+        self.ford = Manufacturer('ford', 'US')
+        self.nsbikes = Manufacturer('nsbikes', 'PL')
+        self.manufacturers = Filterable([self.ford, self.nsbikes, Manufacturer('fiat', 'IT')])
+
+    def test_inner_join(self):
+        joined = self.people.join(self.manufacturers, on=('vehicle__manufacturer', 'name'))
+        self.assertEqual([(self.alice, self.nsbikes), (self.bob, self.ford)], joined)
+        self.assertEqual([self.bob], [pair.left for pair in joined.filter(right__country='US')])
+
+    def test_inner_join_builds_on_smaller_side(self):
+        adults = Filterable([self.alice, self.bob])
+        joined = adults.join(self.manufacturers, on=('vehicle__manufacturer', 'name'))
+        self.assertIn('building on the source side', joined.explain())
+        self.assertEqual([(self.alice, self.nsbikes), (self.bob, self.ford)], joined)
+
+    def test_inner_join_order_does_not_depend_on_sizes(self):
+        drivers = [self.bob, self.alice, self.bob._replace(name='Rob')]
+        makes = [self.nsbikes, self.ford, self.ford._replace(country='CA')]
+        expected = [
+            (self.bob, self.ford), (self.bob, makes[2]), (self.alice, self.nsbikes),
+            (drivers[2], self.ford), (drivers[2], makes[2]),
+        ]
+        on = ('vehicle__manufacturer', 'name')
+        self.assertEqual(expected, Filterable(drivers).join(makes + [self.ford._replace(name='fiat')], on=on))
+        self.assertEqual(expected, Filterable(drivers).join(makes, on=on))
+        self.assertEqual(expected, Filterable(drivers + [self.marta]).join(makes, on=on))
+
+    def test_semi_and_anti_joins(self):
+        american = self.manufacturers.filter(country='US')
+        self.assertEqual(
+            [self.bob],
+            self.people.join(american, on=('vehicle__manufacturer', 'name'), how='semi')
+        )
+        self.assertEqual(
+            [self.marta, self.joe, self.alice],
+            self.people.join(american, on=('vehicle__manufacturer', 'name'), how='anti')
+        )
+
+    def test_join_on_same_name(self):
+        namesakes = Filterable([{'name': 'Joe'}, {'name': 'Bob'}, {'name': 'Moe'}])
+        self.assertEqual([self.joe, self.bob], self.people.join(namesakes, on='name', how='semi'))
+
+    def test_joins_on_unhashable_keys(self):
+        family = {'children': [self.marta]}
+        families = Filterable([family, {'children': 'none'}])
+        self.assertEqual([self.alice], self.people.join(families, on='children', how='semi'))
+        self.assertEqual([self.marta, self.joe, self.bob], self.people.join(families, on='children', how='anti'))
+        self.assertEqual([(self.alice, family)], self.people.join(families, on='children'))
+        more_families = [family, {'children': (1,)}, {'children': []}, family, {'children': None}]
+        self.assertEqual(
+            [(self.marta, more_families[2]), (self.joe, more_families[2]), (self.alice, family), (self.alice, family)],
+            self.people.join(more_families, on='children')
+        )
+        self.assertIn('building on the source side', self.people.join(more_families, on='children').explain())
+
+    def test_unknown_join_type(self):
+        with self.assertRaises(ValueError):
+            self.people.join(self.manufacturers, on='name', how='outer')
+
+    def test_in_filterable(self):
+        names = self.manufacturers.exclude(country='IT').values_list('name', flat=True)
+        self.assertEqual([self.alice, self.bob], self.people.filter(vehicle__manufacturer__in=names))
+
+    def test_in_filterable_is_not_cached(self):
+        self.people.enable_cache()
+        names = Filterable(['ford'])
+        self.assertEqual([self.bob], self.people.filter(vehicle__manufacturer__in=names))
+        names.append('nsbikes')
+        self.assertEqual([self.alice, self.bob], self.people.filter(vehicle__manufacturer__in=names))
+
+
+class TestPagination(FilteratorTestCase):
+    def setUp(self):
+        super(TestPagination, self).setUp()
+        self.numbers = Filterable([
+            {'id': position, 'group': position % 3, 'value': (position * 7) % 10}
+            for position in xrange(20)
+        ])
+
+    def collect_pages(self, ordered, page_size):
+        pages, cursor = [], None
+        while True:
+            page = ordered.paginate(page_size, cursor)
+            pages.append(page.items)
+            if not page.has_next:
+                self.assertIsNone(page.cursor)
+                return pages
+            cursor = page.cursor
+
+    def assertPagesMatch(self, ordered, page_size=3):
+        expected = list(ordered)
+        pages = self.collect_pages(ordered, page_size)
+        self.assertEqual(expected, sum(pages, []))
+        self.assertTrue(all(len(page) == page_size for page in pages[:-1]))
+
+    def test_pages(self):
+        self.assertPagesMatch(self.numbers.order_by('value', 'id'))
+        self.assertPagesMatch(self.numbers.order_by('-value', '-id'), page_size=7)
+        self.assertPagesMatch(self.numbers.order_by('group', '-value', 'id'), page_size=4)
+
+    def test_cursor(self):
+        page = self.people.order_by('age').paginate(2)
+        self.assertEqual(Page([self.marta, self.joe], (7,), True), page)
+        self.assertEqual([self.alice, self.bob], self.people.order_by('age').after(page.cursor))
+        self.assertEqual([self.bob], self.people.order_by('age').after((23,)).limit(1))
+
+    def test_filtered_ordering(self):
+        page = self.people.order_by('age').filter(sex='M').paginate(1)
+        self.assertEqual(Page([self.joe], (7,), True), page)
+        self.assertEqual([self.bob], self.people.order_by('age').filter(sex='M').after(page.cursor))
+        self.assertPagesMatch(self.numbers.order_by('-value', 'id').exclude(group=0))
+
+    def test_requires_ordering(self):
+        with self.assertRaises(ValueError):
+            self.people.paginate(2)
+        with self.assertRaises(ValueError):
+            self.people.after((7,))
+
+    def test_sorted_index(self):
+        self.numbers.create_index('id', 'sorted')
+        ordered = self.numbers.filter(group=1).order_by('-id')
+        self.assertIn('Walk SortedIndex on id', ordered.after((13,)).explain())
+        self.assertPagesMatch(ordered)
+        self.assertPagesMatch(self.numbers.order_by('id'), page_size=6)
+        self.assertEqual(
+            [{'id': 19, 'group': 1, 'value': 3}],
+            self.numbers.order_by('id').after((18,))
+        )
+
+    def test_sorted_index_keeps_order_of_ties(self):
+        self.numbers.create_index('value', 'sorted')
+        for key in ('value', '-value'):
+            ordered = self.numbers.order_by(key)
+            self.assertEqual(list(ordered), ordered[:20])
+            self.assertIn('Walk SortedIndex', ordered.limit(20).explain())
+
+
+class TestBenchmarks(unittest2.TestCase):
+    def test_every_benchmark_runs(self):
+        import benchmarks
+        for name, kinds, function in benchmarks.build_benchmarks():
+            for kind in kinds:
+                result = benchmarks.measure(function, kind, 20, repeat=1)
+                self.assertGreater(result['ops_per_sec'], 0)
+
+    def test_regressions(self):
+        import benchmarks
+        baseline = [{'benchmark': 'count', 'records': 'dict', 'size': 10, 'ops_per_sec': 100.0}]
+        slower = [dict(baseline[0], ops_per_sec=70.0)]
+        self.assertEqual([(baseline[0], slower[0])], benchmarks.find_regressions(baseline, slower, 0.2))
+        self.assertEqual([], benchmarks.find_regressions(baseline, slower, 0.5))
+
+
+class TestInstrumentation(FilteratorTestCase):
+    def test_filter_stats(self):
+        with profile() as report:
+            list(self.people.filter(sex='M').exclude(name__startswith='J'))
+        filter_stats, exclude_stats, scan_stats = report
+        self.assertEqual(('FilterCommand', 4, 2), (filter_stats.name, filter_stats.scanned, filter_stats.passed))
+        self.assertEqual(('ExcludeCommand', 2, 1), (exclude_stats.name, exclude_stats.scanned, exclude_stats.passed))
+        self.assertEqual(('FilteredIterable', 4, 1), (scan_stats.name, scan_stats.scanned, scan_stats.passed))
+        constraint_stats, = filter_stats.constraints
+        self.assertEqual(("sex__exact='M'", 4, 2), (
+            constraint_stats.description, constraint_stats.evaluations, constraint_stats.passed
+        ))
+        self.assertGreaterEqual(constraint_stats.time, 0)
+
+    def test_order_and_terminal_stats(self):
+        with profile() as report:
+            self.people.order_by('-age').first()
+        order_stats, first_stats = report
+        self.assertEqual(('KeyOrderingStrategy', 4, 1), (order_stats.name, order_stats.scanned, order_stats.passed))
+        self.assertEqual('FirstCommand', first_stats.name)
+
+    def test_hooks(self):
+        collected = []
+        add_hook(collected.append)
+        try:
+            self.people.count()
+        finally:
+            remove_hook(collected.append)
+        self.assertEqual(['CountCommand'], [stats.name for stats in collected])
+        self.assertEqual([], hooks)
+
+    def test_explain(self):
+        self.people.create_index('sex')
+        query = self.people.filter(lambda p: True, sex='F').exclude(age__lt=7).order_by('-age')[:1]
+        self.assertEqual([self.alice], query)
+        self.assertEqual('\n'.join([
+            'Scan list of 4 items',
+            "Look up sex__exact='F' in HashIndex on sex",
+            "FilterCommand: sex__exact='F' (cost 1), <callable <lambda>> (cost 10)",
+            'ExcludeCommand: age__lt=7 (cost 1)',
+            'Order by -age using KeyOrderingStrategy',
+        ]), self.people.filter(lambda p: True, sex='F').exclude(age__lt=7).order_by('-age').explain())
+
+    def test_explain_limit(self):
+        self.assertEqual(
+            'Scan list of 4 items\nOrder by name using KeyOrderingStrategy\nSelect top 2 items with a bounded heap',
+            self.people.order_by('name').limit(2).explain()
+        )
+
+
+class CountingIterable(object):
+    def __init__(self, items):
+        self.items = items
+        self.passes = 0
+        self.yielded = 0
+
+    def __iter__(self):
+        self.passes += 1
+        for item in self.items:
+            self.yielded += 1
+            yield item
+
+
+class TestLazyEvaluation(FilteratorTestCase):
+    def setUp(self):
+        super(TestLazyEvaluation, self).setUp()
+        self.source = CountingIterable(list(self.people))
+        self.people = Filterable(self.source)
+
+    def test_filter_is_not_evaluated_until_iterated(self):
+        calls = []
+        men = self.people.filter(lambda p: calls.append(p) or p.sex == 'M')
+        self.assertEqual([], calls)
+        self.assertEqual([self.joe, self.bob], list(men))
+        self.assertEqual(4, len(calls))
+
+    def test_chain_makes_single_pass(self):
+        query = self.people.filter(sex='M').exclude(name='Joe').order_by('-age')
+        self.assertEqual(0, self.source.passes)
+        self.assertEqual([self.bob], query)
+        self.assertEqual(1, self.source.passes)
+
+    def test_count(self):
+        self.assertEqual(2, self.people.filter(sex='F').exclude(age__lt=2).count())
+        self.assertEqual(1, self.source.passes)
+
+    def test_indexing(self):
+        query = self.people.filter(sex='M')
+        self.assertEqual(self.joe, query[0])
+        self.assertEqual(self.bob, query[-1])
+        self.assertEqual([self.bob], query[1:])
+        with self.assertRaises(IndexError):
+            query[2]
+
+    def test_exists_stops_at_first_match(self):
+        self.assertTrue(self.people.filter(sex='F').exists())
+        self.assertEqual(1, self.source.yielded)
+
+    def test_get_stops_at_second_match(self):
+        with self.assertRaises(MultipleValuesReturned):
+            self.people.get(sex='F')
+        self.assertEqual(3, self.source.yielded)
+
+    def test_first_stops_at_first_match(self):
+        self.assertEqual(self.joe, self.people.first(sex='M'))
+        self.assertEqual(2, self.source.yielded)
+
+    def test_iterator_source_is_read_once(self):
+        adults = Filterable(iter(self.source)).filter(age__gt=18)
+        self.assertEqual(2, adults.count())
+        self.assertEqual([self.alice, self.bob], list(adults))
+        self.assertEqual(1, self.source.passes)
+
+    def test_order_by_is_chainable(self):
+        self.assertEqual(
+            [self.alice, self.marta],
+            self.people.order_by('-age').filter(sex='F')
+        )
+
 
 if __name__ == '__main__':
     unittest2.main()
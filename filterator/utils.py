@@ -1,8 +1,130 @@
+import inspect
+from operator import attrgetter, itemgetter, methodcaller
+
+
+PATH_SEPARATOR = '__'
+
+# Strings are compared case-insensitively by their casefold(),
+# or lower() on versions which don't have it
+FOLD_METHOD = 'casefold' if hasattr(u'', 'casefold') else 'lower'
+fold = methodcaller(FOLD_METHOD)
+
+_accessors = {}
+_steps = {}
+
+
 def resolve_value(obj, name):
-    for attr in name.split('__'):
-        obj = getattr(obj, attr)
+    return get_accessor(name)(obj)
+
+
+def is_iterator(iterable):
+    """
+    Tells whether `iterable` can only be iterated once
+    """
+    return iter(iterable) is iterable
+
+
+def get_accessor(name):
+    """
+    Returns a callable resolving `name` (a `__`-separated path) on an object.
+    Accessors are shared between queries, and each one specializes itself
+    once per type of object it meets, so resolving a value on an item
+    costs a dictionary lookup and a prebuilt getter call.
+    """
+    try:
+        return _accessors[name]
+    except KeyError:
+        accessor = _accessors[name] = build_accessor(tuple(name.split(PATH_SEPARATOR)))
+        return accessor
+
+
+def build_accessor(parts):
+    specialized = {}
+
+    def accessor(obj):
+        cls = obj.__class__
+        compiled = specialized.get(cls)
+        if compiled is None:
+            compiled = specialized[cls] = compile_accessor(cls, parts)
+        return compiled(obj)
+    return accessor
+
+
+def compile_accessor(cls, parts):
+    head, tail = parts[0], parts[1:]
+    getter = compile_getter(cls, head)
+    if getter is None:
+        return methodcaller(head)
+    if not tail:
+        def accessor(obj):
+            obj = getter(obj)
+            if obj is not None and hasattr(obj, '__call__'):
+                return obj()
+            return obj
+        return accessor
+    rest = get_accessor(PATH_SEPARATOR.join(tail))
+
+    def accessor(obj):
+        obj = getter(obj)
         if obj is None:
             return None
         if hasattr(obj, '__call__'):
             return obj()
-    return obj
+        return rest(obj)
+    return accessor
+
+
+def get_step(name):
+    """
+    Returns a callable resolving a single path segment on an object,
+    the way accessors do, as a (value, final) pair. `final` tells
+    whether resolution of longer paths stops there: at None values,
+    methods and other callables, whose results are returned instead.
+    """
+    try:
+        return _steps[name]
+    except KeyError:
+        step = _steps[name] = build_step(name)
+        return step
+
+
+def build_step(name):
+    specialized = {}
+
+    def step(obj):
+        cls = obj.__class__
+        compiled = specialized.get(cls)
+        if compiled is None:
+            compiled = specialized[cls] = compile_step(cls, name)
+        return compiled(obj)
+    return step
+
+
+def compile_step(cls, name):
+    getter = compile_getter(cls, name)
+    if getter is None:
+        method = methodcaller(name)
+        return lambda obj: (method(obj), True)
+
+    def step(obj):
+        obj = getter(obj)
+        if obj is None:
+            return None, True
+        if hasattr(obj, '__call__'):
+            return obj(), True
+        return obj, False
+    return step
+
+
+def compile_getter(cls, attr):
+    """
+    Returns None for methods, which are called right away
+    """
+    if issubclass(cls, dict):
+        return itemgetter(attr)
+    fields = getattr(cls, '_fields', None)
+    if isinstance(fields, tuple) and attr in fields and issubclass(cls, tuple):
+        return itemgetter(fields.index(attr))
+    if inspect.ismethod(getattr(cls, attr, None)):
+        return None
+    return attrgetter(attr)
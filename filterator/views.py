@@ -0,0 +1,92 @@
+from bisect import bisect_left, bisect_right
+
+from query import LazyIterable
+
+
+__all__ = (
+    'MaterializedView',
+)
+
+
+class MaterializedView(LazyIterable):
+    """
+    Result of a filter and order query over a list, kept up to date
+    as the list is mutated. Items are stored sorted by their ordering key
+    and a sequence number following their position in the list (so equal
+    items keep their order), hence a mutation only tests and bisects
+    the item it concerns, and reading the view doesn't evaluate anything.
+    """
+
+    def __init__(self, test, comparison_key, items):
+        self.test = test
+        self.comparison_key = comparison_key or get_empty_key
+        self.build(items)
+
+    def build(self, items):
+        comparison_key = self.comparison_key
+        self.sequences = range(len(items))
+        entries = sorted(
+            ((comparison_key(item), sequence), item)
+            for sequence, item in enumerate(items) if self.test(item)
+        )
+        self.keys = [key for key, _ in entries]
+        self.items = [item for _, item in entries]
+        self.next_sequence = len(items)
+
+    def add(self, item):
+        """
+        Registers an item appended to the end of the list
+        """
+        self.sequences.append(self.next_sequence)
+        self.next_sequence += 1
+        self.insert(item, self.sequences[-1])
+
+    def discard(self, position, item):
+        """
+        Unregisters the item which was at `position` of the list
+        """
+        self.remove_entry(item, self.sequences.pop(position))
+
+    def replace(self, position, item, new_item):
+        """
+        Registers `new_item` in place of `item` at `position` of the list
+        """
+        sequence = self.sequences[position]
+        self.remove_entry(item, sequence)
+        self.insert(new_item, sequence)
+
+    def insert(self, item, sequence):
+        if not self.test(item):
+            return
+        key = self.comparison_key(item), sequence
+        position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.items.insert(position, item)
+
+    def remove_entry(self, item, sequence):
+        if not self.test(item):
+            return
+        key = self.comparison_key(item), sequence
+        position = bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            del self.keys[position]
+            del self.items[position]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def get_item(self, index):
+        return self.items[index]
+
+    def get_slice(self, key):
+        return self.items[key]
+
+    def explain(self):
+        return ['Read materialized view of %d items' % len(self.items)]
+
+
+def get_empty_key(item):
+    return ()